@@ -0,0 +1,208 @@
+import sys
+
+if sys.version_info.major < 3 or sys.version_info.minor < 10:
+    print("Python 3.10 or higher is required.")
+    sys.exit(1)
+
+import argparse
+import json
+import platform
+import time
+import tracemalloc
+
+from tokenbag import PullType, TokenBag
+
+# Synthetic bag built from the Base bag with every token count multiplied
+LARGE_BAG = "Large"
+LARGE_SCALE = 25
+
+
+def load_config(filename: str) -> dict:
+    """Read the config, adding the synthetic large bag"""
+    with open(filename) as f:
+        config = json.load(f)
+    base = config["Bag Pool"]["Base"]
+    config["Bag Pool"][LARGE_BAG] = {
+        "Config": {"max_draws": 10},
+        "Specification": [
+            {name: count * LARGE_SCALE for name, count in bag.items()}
+            for bag in base["Specification"]
+        ],
+    }
+    return config
+
+
+def make_bag(config: dict, bag_name: str, seed: int) -> TokenBag:
+    """Return a TokenBag for one of the bags in the config"""
+    pool = TokenBag(False, None, seed)
+    pool.import_config_json(config, bag_name=bag_name)
+    return pool
+
+
+def measure(fn, number: int) -> dict:
+    """Time number calls of fn, then trace the memory allocated by one call"""
+    fn()
+    start = time.perf_counter()
+    for _ in range(number):
+        fn()
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "calls": number,
+        "seconds": elapsed,
+        "calls_per_second": number / elapsed,
+        "peak_bytes_per_call": peak,
+    }
+
+
+def benchmarks(args: argparse.Namespace) -> dict:
+    """Run every benchmark and return the results keyed by name"""
+    config = load_config(args.config)
+    results = {}
+
+    def run(name: str, fn, number: int) -> None:
+        results[name] = measure(fn, number)
+        stats = results[name]
+        print(
+            f"{name:>40}: {stats['calls_per_second']:>10.0f}/s"
+            f" {stats['peak_bytes_per_call']:>8} peak bytes",
+            file=sys.stderr,
+        )
+
+    loads = max(1, args.number // 100)
+    run(
+        "read_config_file",
+        lambda: TokenBag(False, None).read_config_file(args.config),
+        loads,
+    )
+    run(
+        f"import_config_json[{LARGE_BAG}]",
+        lambda: TokenBag(False, None).import_config_json(config, LARGE_BAG),
+        loads,
+    )
+
+    for bag_name in args.bags:
+        pool = make_bag(config, bag_name, args.seed)
+        rules = pool.pull_rules()
+        run(
+            f"_replayable_pull[{bag_name}]",
+            lambda pool=pool, rules=rules: pool._replayable_pull(rules),
+            args.number,
+        )
+        run(f"pull[{bag_name}]", pool.pull, args.number)
+        for pull_type in PullType:
+            run(
+                f"pull_one[{bag_name},{pull_type.name}]",
+                lambda pull_type=pull_type, pool=pool: pool.pull_one(
+                    pool.max_rank, pull_type
+                ),
+                args.number,
+            )
+        run(f"resistance_pull[{bag_name}]", pool.resistance_pull, args.number)
+        for pull_type in PullType:
+            run(
+                f"pull_many[{bag_name},{pull_type.name}]",
+                lambda pull_type=pull_type, pool=pool: pool.pull_many(
+                    pool.max_rank, pull_type, 100
+                ),
+                max(1, args.number // 100),
+            )
+
+    pool = make_bag(config, "Base", args.seed)
+    run("verify_tests", pool.verify_tests, args.number)
+
+    return results
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """Return the benchmarks that got slower than the baseline by threshold"""
+    regressions = []
+    for name, stats in results.items():
+        if name not in baseline:
+            continue
+        old = baseline[name]["calls_per_second"]
+        new = stats["calls_per_second"]
+        if new < old * (1 - threshold):
+            regressions.append((name, old, new))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the token bag pulls and test verification."
+    )
+    parser.add_argument(
+        "-c",
+        "--config",
+        help="Path to the configuration file. [bagpool.conf.sample]",
+        default="bagpool.conf.sample",
+    )
+    parser.add_argument(
+        "-b",
+        "--bags",
+        help=f"Bags to benchmark pulls from. [Base, Opposed Bags, {LARGE_BAG}]",
+        nargs="+",
+        default=["Base", "Opposed Bags", LARGE_BAG],
+    )
+    parser.add_argument(
+        "-n",
+        "--number",
+        help="Number of calls to time for each benchmark. [2000]",
+        type=int,
+        default=2000,
+    )
+    parser.add_argument(
+        "--seed",
+        help="Seed for shuffling the bag(s) [0]",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "-o", "--output", help="Path to save the results to as JSON.", default=None
+    )
+    parser.add_argument(
+        "--compare",
+        help="Path to the JSON results of an earlier run to compare against.",
+        default=None,
+    )
+    parser.add_argument(
+        "-t",
+        "--threshold",
+        help="Fraction slower than the earlier run that counts as a regression [0.1]",
+        type=float,
+        default=0.1,
+    )
+    args = parser.parse_args()
+
+    output = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "config": args.config,
+        "results": benchmarks(args),
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=4)
+    else:
+        print(json.dumps(output, indent=4))
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(output["results"], baseline["results"], args.threshold)
+        for name, old, new in regressions:
+            print(
+                f"REGRESSION {name}: {old:.0f}/s -> {new:.0f}/s ({new / old - 1:.1%})",
+                file=sys.stderr,
+            )
+        if regressions:
+            sys.exit(1)
+
+
+main()
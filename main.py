@@ -8,8 +8,62 @@ import argparse
 import copy
 import json
 import logging
+import time
 
-from tokenbag import TokenBag
+from tokenbag import OUTCOMES, OddsCache, TokenBag
+
+
+def print_summary(
+    pool: TokenBag, args: argparse.Namespace, rank_stats: dict, total_stats: dict
+) -> None:
+    """Print the summary counts of a set of standard pulls"""
+    print(f"\nSummary Counts: (from {args.number_of_draws} pulls)")
+    for rank in sorted(rank_stats.keys()):
+        stats = rank_stats[rank]
+        name = rank
+        if not args.print_rank_numbers:
+            name = pool.get_rank_name(rank)
+        print(
+            f"{name:>14}: "
+            f".{stats['failures']}f{stats['fortune-failures']} "
+            f"-{stats['partials']}f{stats['fortune-partials']} "
+            f"+{stats['fulls']}f{stats['fortune-fulls']} "
+            f"^{stats['crits']}f{stats['fortune-crits']} "
+        )
+    name = "Totals"
+    print(
+        f"\n{name:>14}: "
+        f".{total_stats['failures']}f{total_stats['fortune-failures']} "
+        f"-{total_stats['partials']}f{total_stats['fortune-partials']} "
+        f"+{total_stats['fulls']}f{total_stats['fortune-fulls']} "
+        f"^{total_stats['crits']}f{total_stats['fortune-crits']} "
+    )
+
+
+def report_progress(done: int, total: int, started: float, last: float) -> float:
+    """Report progress to stderr every few seconds, returning the last report"""
+    now = time.monotonic()
+    if now - last < 5 and done < total:
+        return last
+    rate = done / max(now - started, 1e-9)
+    print(
+        f"{done}/{total} pulls ({done / total:.0%}), {rate:.0f} pulls/s",
+        file=sys.stderr,
+    )
+    return now
+
+
+def parse_sweep(sweeps: list) -> dict:
+    """Parse name=v1,v2,... or name=first:last options into a grid"""
+    grid = {}
+    for sweep in sweeps:
+        name, _, values = sweep.partition("=")
+        if ":" in values:
+            first, _, last = values.partition(":")
+            grid[name] = list(range(int(first), int(last) + 1))
+        else:
+            grid[name] = [json.loads(value) for value in values.split(",")]
+    return grid
 
 
 def main():
@@ -93,7 +147,102 @@ def main():
         default=False,
     )
 
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help=(
+            "Number of processes to run the verification tests and standard"
+            " pulls across, only printing the summary of the pulls if more"
+            " than one. 0 - one per CPU [1]"
+        ),
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--seed",
+        help="Seed for shuffling the bag(s), for repeatable pulls",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--first-pull",
+        help=(
+            "Index of the first pull to make from the --seed run, to regenerate"
+            " a single pull without replaying the pulls before it. Needs --seed [0]"
+        ),
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "-x",
+        "--exact",
+        action="store_true",
+        help="Calculate exact odds rather than sampling pulls [False]",
+        default=False,
+    )
+
+    parser.add_argument(
+        "--snapshot-dir",
+        help=(
+            "Directory to save the compiled bag in, to skip parsing the"
+            " configuration on later runs while it is unchanged"
+        ),
+        default=None,
+    )
+    parser.add_argument(
+        "--odds-cache",
+        help="Directory to cache exact odds in, to reuse them across runs",
+        default=None,
+    )
+    parser.add_argument(
+        "--stats",
+        help=(
+            "Count and time the work done by the pulls, saving the counters as"
+            " JSON to this path at the end of the run ('-' to print them)"
+        ),
+        default=None,
+    )
+    parser.add_argument(
+        "-S",
+        "--summary-only",
+        action="store_true",
+        help=(
+            "Only count the pulls and print the summary, reporting progress"
+            " to stderr [False]"
+        ),
+        default=False,
+    )
+
+    parser.add_argument(
+        "--sweep",
+        help=(
+            "Pull setting to sweep over, as name=v1,v2,... or name=first:last."
+            " Repeat for each setting to sweep, printing a table of the outcome"
+            " rates of the same pulls for every combination"
+        ),
+        action="append",
+        default=[],
+    )
+
+    parser.add_argument(
+        "--vary",
+        help=(
+            "Token count changes to calculate exact odds for, as"
+            " name=d1,d2,... or name=first:last. Repeat for each token to"
+            " vary, printing a table of the odds of every combination"
+        ),
+        action="append",
+        default=[],
+    )
+    parser.add_argument(
+        "--export",
+        help="Path to save the full --sweep, --vary or -x -R results to as JSON",
+        default=None,
+    )
+
     args = parser.parse_args()
+    if args.first_pull is not None and args.seed is None:
+        parser.error("--first-pull requires --seed")
 
     if not args.debug:
         logging.basicConfig(
@@ -111,9 +260,18 @@ def main():
         )
     logger = logging.getLogger(__name__)
 
-    pool = TokenBag(args.debug, args.log)
+    pool = TokenBag(args.debug, args.log, args.seed)
+    if args.seed is not None:
+        pool.jump(args.first_pull or 0)
+    if args.stats:
+        pool.enable_stats()
+    if args.odds_cache:
+        pool.odds_cache = OddsCache(directory=args.odds_cache)
     pool.read_config_file(
-        args.config, bag_name=args.bag, tests=bool(not args.skip_verify_tests)
+        args.config,
+        bag_name=args.bag,
+        tests=bool(not args.skip_verify_tests),
+        snapshot_dir=args.snapshot_dir,
     )
     pool.configure_pull(max_draws=args.draw_cap, sums=args.sums)
 
@@ -121,7 +279,7 @@ def main():
     run_pulls = True
     if not args.skip_verify_tests:
         print("\nVerifying Tests")
-        (run_pulls, results) = pool.verify_tests()
+        (run_pulls, results) = pool.verify_tests(args.jobs)
         print("\nTest Results:")
         print(json.dumps(results).replace("}", "}\n"))
 
@@ -129,13 +287,128 @@ def main():
         print("\n\nERROR: Test Verifications failed. Aborting pulls")
         return
 
-    if not args.resistance:
+    if args.sweep:
+        print("\nSweeping pull settings")
+        ranks = None if args.rank < 0 else [args.rank]
+        results = pool.sweep(
+            parse_sweep(args.sweep), args.number_of_draws, ranks, args.seed
+        )
+        names = list(results["rows"][0]["parameters"]) if results["rows"] else []
+        print(
+            f"\nOutcome Rates: (from {results['pulls']} pulls,"
+            f" {results['distinct-pulls']} distinct)"
+        )
+        print("\t".join(names + ["rank"] + results["outcomes"]))
+        for row in results["rows"]:
+            for rank, rates in zip(results["ranks"], row["rates"], strict=True):
+                name = rank
+                if not args.print_rank_numbers:
+                    name = pool.get_rank_name(rank)
+                print(
+                    "\t".join(
+                        [str(value) for value in row["parameters"].values()]
+                        + [str(name)]
+                        + [f"{rate:.2%}" for rate in rates]
+                    )
+                )
+        if args.export:
+            with open(args.export, "w") as f:
+                json.dump(results, f, indent=4)
+    elif args.vary:
+        print("\nCalculating exact odds for each bag variation")
+        results = pool.composition_odds(parse_sweep(args.vary))
+        print(f"\nExact Odds: (drawing up to {pool.max_draws} tokens)")
+        print("\t".join(results["tokens"] + ["rank"] + list(OUTCOMES)))
+        for row in results["rows"]:
+            for chances in row["odds"][-1]["ranks"] if row["odds"] else []:
+                if chances["rank"] != args.rank and args.rank >= 0:
+                    continue
+                name = chances["rank"]
+                if not args.print_rank_numbers:
+                    name = pool.get_rank_name(chances["rank"])
+                print(
+                    "\t".join(
+                        [str(count) for count in row["counts"].values()]
+                        + [str(name)]
+                        + [f"{chances[outcome]:.2%}" for outcome in OUTCOMES]
+                    )
+                )
+        if args.export:
+            with open(args.export, "w") as f:
+                json.dump(results, f, indent=4)
+    elif args.exact and not args.resistance:
+        print("\nCalculating exact odds")
+        odds = pool.odds()
+        print(f"\nExact Odds: (drawing up to {pool.max_draws} tokens)")
+        for chances in odds[-1]["ranks"] if odds else []:
+            if chances["rank"] != args.rank and args.rank >= 0:
+                continue
+            name = chances["rank"]
+            if not args.print_rank_numbers:
+                name = pool.get_rank_name(chances["rank"])
+            print(
+                f"{name:>14}: "
+                f".{chances['failure']:.2%}f{chances['fortune-failure']:.2%} "
+                f"-{chances['partial']:.2%}f{chances['fortune-partial']:.2%} "
+                f"+{chances['full']:.2%}f{chances['fortune-full']:.2%} "
+                f"^{chances['crit']:.2%}f{chances['fortune-crit']:.2%} "
+            )
+    elif args.exact:
+        print("\nCalculating exact Resistance costs")
+        odds = pool.resistance_odds()
+        print("\nExact Resistance Costs: (mitigated+ taken~ lost$ chance)")
+        for chances in odds[-1]["ranks"] if odds else []:
+            if chances["rank"] != args.rank and args.rank >= 0:
+                continue
+            name = chances["rank"]
+            if not args.print_rank_numbers:
+                name = pool.get_rank_name(chances["rank"])
+            for cost in chances["costs"]:
+                print(
+                    f"{name:>14}:"
+                    f" {cost['mitigated']:>3}+"
+                    f" {cost['taken']:>3}~"
+                    f" {cost['lost']:>3}$"
+                    f" {cost['chance']:>8.2%}"
+                )
+            expected = chances["expected"]
+            variance = chances["variance"]
+            print(
+                f"{'Expected':>14}:"
+                f" {expected['mitigated']:.3f}+"
+                f" {expected['taken']:.3f}~"
+                f" {expected['lost']:.3f}$\n"
+                f"{'Variance':>14}:"
+                f" {variance['mitigated']:.3f}+"
+                f" {variance['taken']:.3f}~"
+                f" {variance['lost']:.3f}$\n"
+            )
+        if args.export:
+            with open(args.export, "w") as f:
+                json.dump(odds, f, indent=4)
+    elif not args.resistance and args.jobs != 1:
+        print("\nRunning pulls across processes")
+        ranks = None if args.rank < 0 else [args.rank]
+        results = pool.simulate_parallel(
+            args.number_of_draws, args.jobs, ranks, args.seed
+        )
+        rank_stats = {}
+        total_stats = {"rank": None}
+        for rank, counts in zip(results["ranks"], results["counts"][-1], strict=True):
+            rank_stats[rank] = {"rank": rank}
+            for outcome, count in zip(OUTCOMES, counts, strict=True):
+                rank_stats[rank][f"{outcome}s"] = count
+                total_stats[f"{outcome}s"] = total_stats.get(f"{outcome}s", 0) + count
+        print_summary(pool, args, rank_stats, total_stats)
+    elif not args.resistance:
         print("\nRunning a pull")
         rank_stats = {}
         total_stats = {}
-        for _ in range(args.number_of_draws):
+        started = last = time.monotonic()
+        for done in range(1, args.number_of_draws + 1):
             for pull in pool.pull()[-1]["ranks"]:
-                logger.debug(json.dumps(pull).replace("}", "}\n"))
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(json.dumps(pull).replace("}", "}\n"))
                 if pull["rank"] != args.rank and args.rank >= 0:
                     continue
                 if pull["rank"] not in rank_stats:
@@ -153,11 +426,6 @@ def main():
                 if len(total_stats) == 0:
                     total_stats = copy.deepcopy(rank_stats[pull["rank"]])
                 stats = rank_stats[pull["rank"]]
-                crit = "^" if pull["can-crit"] == "Y" else " "
-
-                name = pull["rank"]
-                if not args.print_rank_numbers:
-                    name = pool.get_rank_name(pull["rank"])
 
                 base = ""
                 if pull["failure"]:
@@ -195,6 +463,14 @@ def main():
                     stats["fortune-fulls"] += 1
                     total_stats["fortune-fulls"] += 1
 
+                if args.summary_only:
+                    continue
+
+                crit = "^" if pull["can-crit"] == "Y" else " "
+                name = pull["rank"]
+                if not args.print_rank_numbers:
+                    name = pool.get_rank_name(pull["rank"])
+
                 if args.sums:
                     print(
                         f"{crit}{pull['rank']}:"
@@ -209,36 +485,20 @@ def main():
                         f" {pull['fortune-hits']}/{pull['fortune-misses']}f{fortune}"
                         f" pull: {', '.join(pull['fortune-pull-order'])}"
                     )
+            if args.summary_only:
+                last = report_progress(done, args.number_of_draws, started, last)
 
-        print(f"\nSummary Counts: (from {args.number_of_draws} pulls)")
-        for rank in sorted(rank_stats.keys()):
-            stats = rank_stats[rank]
-            name = rank
-            if not args.print_rank_numbers:
-                name = pool.get_rank_name(rank)
-            print(
-                f"{name:>14}: "
-                f".{stats['failures']}f{stats['fortune-failures']} "
-                f"-{stats['partials']}f{stats['fortune-partials']} "
-                f"+{stats['fulls']}f{stats['fortune-fulls']} "
-                f"^{stats['crits']}f{stats['fortune-crits']} "
-            )
-        name = "Totals"
-        print(
-            f"\n{name:>14}: "
-            f".{total_stats['failures']}f{total_stats['fortune-failures']} "
-            f"-{total_stats['partials']}f{total_stats['fortune-partials']} "
-            f"+{total_stats['fulls']}f{total_stats['fortune-fulls']} "
-            f"^{total_stats['crits']}f{total_stats['fortune-crits']} "
-        )
+        print_summary(pool, args, rank_stats, total_stats)
     else:
         print("\nRunning a Resistance pull")
         rank_stats = {}
         total_stats = {}
-        for _ in range(args.number_of_draws):
+        started = last = time.monotonic()
+        for done in range(1, args.number_of_draws + 1):
             record = ""
             for pull in pool.resistance_pull()[-1]["ranks"]:
-                logger.debug(json.dumps(pull).replace("}", "}\n"))
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(json.dumps(pull).replace("}", "}\n"))
                 if pull["rank"] != args.rank and args.rank >= 0:
                     continue
                 if pull["rank"] not in rank_stats:
@@ -254,10 +514,6 @@ def main():
                     total_stats = copy.deepcopy(rank_stats[pull["rank"]])
                 stats = rank_stats[pull["rank"]]
 
-                name = pull["rank"]
-                if not args.print_rank_numbers:
-                    name = pool.get_rank_name(pull["rank"])
-
                 total_stats["costs"]["mitigated"] += pull["costs"]["mitigated"]
                 total_stats["costs"]["taken"] += pull["costs"]["taken"]
                 total_stats["costs"]["lost"] += pull["costs"]["lost"]
@@ -265,6 +521,13 @@ def main():
                 stats["costs"]["taken"] += pull["costs"]["taken"]
                 stats["costs"]["lost"] += pull["costs"]["lost"]
 
+                if args.summary_only:
+                    continue
+
+                name = pull["rank"]
+                if not args.print_rank_numbers:
+                    name = pool.get_rank_name(pull["rank"])
+
                 if not record:
                     record = f"{''.ljust(12)}{', '.join(pull['pull-order'])}\n"
                 record += (
@@ -273,7 +536,10 @@ def main():
                     f" {pull['costs']['taken']:>3}~"
                     f" {pull['costs']['lost']:>3}$\n"
                 )
-            print(record)
+            if args.summary_only:
+                last = report_progress(done, args.number_of_draws, started, last)
+            else:
+                print(record)
 
         print(f"\nSummary Counts: (from {args.number_of_draws} Resistance pulls)")
         for rank in sorted(rank_stats.keys()):
@@ -295,5 +561,12 @@ def main():
             f" {total_stats['costs']['lost']:>4}$"
         )
 
+    if args.stats == "-":
+        print("\nPull Stats:")
+        print(json.dumps(pool.stats.to_dict(), indent=4))
+    elif args.stats:
+        with open(args.stats, "w") as f:
+            json.dump(pool.stats.to_dict(), f, indent=4)
+
 
 main()
@@ -0,0 +1,260 @@
+import sys
+
+if sys.version_info.major < 3 or sys.version_info.minor < 10:
+    print("Python 3.10 or higher is required.")
+    sys.exit(1)
+
+import argparse
+import asyncio
+import contextlib
+import copy
+import json
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+from tokenbag import PULL_COLUMNS, OddsCache, PullType, TokenBag
+
+# Requests that are answered in a worker process, so they don't hold up others
+SLOW_OPS = ("odds", "resistance_odds", "simulate")
+
+
+class BagServer:
+    """Answer pull and odds requests for a set of loaded bags
+
+    Each request is a JSON object on its own line, such as
+    `{"id": 1, "op": "pull_one", "bag": "Base", "rank": 2, "type": "Action"}`,
+    and is answered with a line of `{"id": 1, "result": ...}` or
+    `{"id": 1, "error": "..."}`. Requests on one connection are answered as they
+    finish, so the id is echoed back to match them up.
+    """
+
+    def __init__(
+        self, bags: dict, executor: ProcessPoolExecutor, max_pulls: int
+    ) -> None:
+        self.bags = bags
+        self.executor = executor
+        # Most pulls a pull_many request can ask for, as it runs in the event loop
+        self.max_pulls = max_pulls
+
+    def bag(self, request: dict) -> TokenBag:
+        name = request.get("bag", next(iter(self.bags)))
+        if name not in self.bags:
+            raise ValueError(f"Unknown bag `{name}`")
+        return self.bags[name]
+
+    def answer(self, request: dict):
+        """Answer a fast request in the event loop"""
+        op = request.get("op")
+        if op == "bags":
+            return {
+                name: {"max_rank": bag.max_rank, "ranks": bag.ranks}
+                for name, bag in self.bags.items()
+            }
+        bag = self.bag(request)
+        if op in ("pull_one", "pull_many"):
+            rank = int(request.get("rank", bag.max_rank))
+            if not 0 <= rank <= bag.max_rank:
+                raise ValueError(f"Rank {rank} is not from 0 to {bag.max_rank}")
+            pull_type = PullType[request.get("type", "Action")]
+            if op == "pull_one":
+                return bag.pull_one(rank, pull_type)
+            n = int(request.get("n", 1))
+            if not 0 <= n <= self.max_pulls:
+                raise ValueError(f"Pulls {n} is not from 0 to {self.max_pulls}")
+            results = bag.pull_many(
+                rank, pull_type, n, bool(request.get("orders", False))
+            )
+            for name in PULL_COLUMNS:
+                results[name] = [column.tolist() for column in results[name]]
+            return results
+        if op == "resistance_pull":
+            return bag.resistance_pull()
+        if op == "pull":
+            return bag.pull()
+        raise ValueError(f"Unknown op `{op}`")
+
+    def worker_bag(self, bag: TokenBag) -> TokenBag:
+        """Return a copy of bag that is cheap to send to a worker process
+
+        Leaves out the odds cache, stats and Test Pulls, which the workers
+        don't use, so they aren't pickled with every request.
+        """
+        worker = copy.copy(bag)
+        worker.odds_cache = None
+        worker.stats = None
+        worker.test_pulls = []
+        return worker
+
+    async def answer_slow(self, request: dict):
+        """Answer a request that needs a lot of computation in the executor"""
+        loop = asyncio.get_running_loop()
+        bag = self.bag(request)
+        rules = bag.pull_rules()
+        worker = self.worker_bag(bag)
+        if request["op"] == "odds":
+            key = bag.odds_key(rules)
+            odds = bag.odds_cache.get(key)
+            if odds is None:
+                odds = await loop.run_in_executor(self.executor, worker._odds, rules)
+                bag.odds_cache.put(key, odds)
+            return odds
+        if request["op"] == "resistance_odds":
+            return await loop.run_in_executor(
+                self.executor, worker.resistance_odds, rules
+            )
+        return await loop.run_in_executor(
+            self.executor,
+            worker.simulate,
+            int(request.get("n", 10000)),
+            request.get("ranks"),
+            request.get("seed"),
+            rules,
+        )
+
+    async def respond(self, line: bytes, writer: asyncio.StreamWriter) -> None:
+        response = {}
+        try:
+            request = json.loads(line)
+            response["id"] = request.get("id")
+            if request.get("op") in SLOW_OPS:
+                response["result"] = await self.answer_slow(request)
+            else:
+                response["result"] = self.answer(request)
+        except Exception as e:
+            logging.getLogger(__name__).debug("Request %r failed", line, exc_info=True)
+            response["error"] = f"{type(e).__name__}: {e}"
+        if not writer.is_closing():
+            writer.write(json.dumps(response).encode() + b"\n")
+
+    async def handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        pending = set()
+        try:
+            while line := await reader.readline():
+                if not line.strip():
+                    continue
+                task = asyncio.create_task(self.respond(line, writer))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+                await writer.drain()
+            if pending:
+                await asyncio.wait(pending)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            for task in pending:
+                task.cancel()
+            writer.close()
+
+
+def load_bags(args: argparse.Namespace) -> dict:
+    """Compile the Bag Pool once and verify each of the bags to serve"""
+    with open(args.config) as f:
+        config = json.load(f)
+    pool = TokenBag(args.debug, args.log, args.seed)
+    pool.odds_cache = OddsCache(directory=args.odds_cache or "")
+    compiled = pool.load_bag_pool(config, tests=not args.skip_verify_tests)
+
+    bags = {}
+    for name in args.bags:
+        if name not in compiled:
+            sys.exit(f"ERROR: No bag `{name}` in {args.config}")
+        bag = compiled[name]
+        if not args.skip_verify_tests:
+            (passed, results) = bag.verify_tests()
+            if not passed:
+                print(json.dumps(results).replace("}", "}\n"), file=sys.stderr)
+                sys.exit(f"ERROR: Test Verifications failed for bag `{name}`")
+        bags[name] = bag
+    return bags
+
+
+async def serve(args: argparse.Namespace) -> None:
+    with ProcessPoolExecutor(max_workers=args.jobs or None) as executor:
+        server = BagServer(load_bags(args), executor, args.max_pulls)
+        if args.unix:
+            listener = await asyncio.start_unix_server(server.handle, path=args.unix)
+        else:
+            listener = await asyncio.start_server(
+                server.handle, host=args.host, port=args.port
+            )
+        names = ", ".join(str(sock.getsockname()) for sock in listener.sockets)
+        print(f"Serving {', '.join(server.bags)} on {names}", file=sys.stderr)
+        async with listener:
+            await listener.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve pulls and odds from token bags over a socket."
+    )
+    parser.add_argument(
+        "-c",
+        "--config",
+        help="Path to the configuration file. [bagpool.conf]",
+        default="bagpool.conf",
+    )
+    parser.add_argument(
+        "-b",
+        "--bags",
+        help="Names of the bags to serve, the first being the default. [Base]",
+        nargs="+",
+        default=["Base"],
+    )
+    parser.add_argument(
+        "-D", "--debug", action="store_true", help="Enable debug mode.", default=False
+    )
+    parser.add_argument("-l", "--log", help="Path to the log file.")
+    parser.add_argument(
+        "-u", "--unix", help="Path of a Unix socket to listen on instead of TCP."
+    )
+    parser.add_argument(
+        "--host", help="Host to listen on. [127.0.0.1]", default="127.0.0.1"
+    )
+    parser.add_argument(
+        "-p", "--port", help="Port to listen on. [8765]", type=int, default=8765
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help="Worker processes for odds and simulations. 0 - one per CPU [0]",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--max-pulls",
+        help="Most pulls a single pull_many request can ask for [10000]",
+        type=int,
+        default=10000,
+    )
+    parser.add_argument(
+        "--seed",
+        help="Seed for shuffling the bag(s), random if not given",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "-V",
+        "--skip-verify-tests",
+        action="store_true",
+        help="Skip running verification tests on the bags before serving [False]",
+        default=False,
+    )
+    parser.add_argument(
+        "--odds-cache",
+        help="Directory to keep exact odds in, to reuse across runs",
+        default=None,
+    )
+    args = parser.parse_args()
+
+    if args.log:
+        logging.basicConfig(filename=args.log, filemode="w", level=logging.DEBUG)
+
+    with contextlib.suppress(KeyboardInterrupt):
+        asyncio.run(serve(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+import json
+import pathlib
+import tracemalloc
+
+import pytest
+
+import tokenbag
+from tokenbag import OUTCOMES, TokenBag, _parse_test
+
+SAMPLE = pathlib.Path(__file__).parent.parent / "bagpool.conf.sample"
+
+
+def sample_config() -> dict:
+    with open(SAMPLE) as f:
+        return json.load(f)
+
+
+def small_bag(max_draws: int = 3, **parameters) -> TokenBag:
+    """Return a bag of 6 sample tokens, with one that steals and one that ends"""
+    config = sample_config()
+    config["Bag Pool"] = {
+        "Small": {
+            "Specification": [
+                {"Hit": 2, "Miss": 1, "Bronze Flip": 1, "Gobbler": 1, "Gobstopper": 1}
+            ]
+        }
+    }
+    config["Config"].update(bag_name="Small", max_draws=max_draws, **parameters)
+    bag = TokenBag(False, None)
+    bag.import_config_json(config, tests=False)
+    return bag
+
+
+class ScriptedRandom:
+    """Random numbers from a script, recording the range of each draw"""
+
+    def __init__(self, script: list) -> None:
+        self.script = script
+        self.ranges = []
+
+    def randrange(self, n: int) -> int:
+        drawn = len(self.ranges)
+        self.ranges.append(n)
+        return self.script[drawn] if drawn < len(self.script) else 0
+
+
+def every_pull(bag: TokenBag):
+    """Yield every pull() of the bag, with the chance of drawing it"""
+    script = []
+    while True:
+        rng = ScriptedRandom(script)
+        bag.set_rng(rng)
+        pull = bag.pull()
+        chance = 1.0
+        for n in rng.ranges:
+            chance /= n
+        yield (pull, chance)
+        # Move on to the next shuffle, like an odometer over the draws
+        drawn = len(rng.ranges)
+        script = script[:drawn] + [0] * (drawn - len(script))
+        while script and script[-1] == rng.ranges[len(script) - 1] - 1:
+            script.pop()
+        if not script:
+            return
+        script[-1] += 1
+
+
+def large_bag(tokens: int) -> TokenBag:
+    """Return a bag of the sample tokens with `tokens` tokens and 3 draws"""
+    config = sample_config()
+    config["Bag Pool"] = {
+        "Large": {
+            "Config": {"max_draws": 3},
+            "Specification": [
+                {"Hit": tokens // 4, "Miss": tokens // 4, "Blank": tokens // 2}
+            ],
+        }
+    }
+    config["Config"]["bag_name"] = "Large"
+    bag = TokenBag(False, None)
+    bag.import_config_json(config, tests=False)
+    return bag
+
+
+def test_shuffled_pulls_only_draw_the_tokens_pulled():
+    np = pytest.importorskip("numpy")
+    bag = large_bag(2500)
+    rules = bag.pull_rules()
+    rng = np.random.default_rng(1)
+    n = 20000
+
+    tracemalloc.start()
+    (the_pulls, lengths) = bag._shuffled_pulls(rng, bag._bag_sequence(rules), n, rules)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    assert the_pulls.shape == (n, 3)
+    assert (lengths <= 3).all()
+    # Shuffling the whole bag for every pull would take n * 2500 * 8 bytes
+    assert peak < n * 2500
+
+
+def test_simulate_large_bag_counts_every_pull():
+    pytest.importorskip("numpy")
+    bag = large_bag(2500)
+    results = bag.simulate(5000, seed=1)
+    for cap in results["counts"]:
+        for rank in cap:
+            # Every pull has one outcome and one fortune outcome
+            assert sum(rank[:4]) == sum(rank[4:]) == 5000
+
+
+@pytest.mark.parametrize(
+    ("test", "message", "position"),
+    [
+        ("", "Expected a rank, found the end", 0),
+        ("²=1.", "Expected a rank, found `²`", 0),
+        ("1=².", "Expected a number, found `²`", 2),
+        ("1 = ٣.", "Expected a number, found `٣`", 4),
+        ("1 = 2x", "Expected a result of `.`, `-`, `+` or `^`, found `x`", 5),
+        ("1&2+", "Expected `/` between hits and misses, found `+`", 3),
+        ("1&2/1", "Expected a result of `.`, `-`, `+` or `^`, found the end", 5),
+        ("1=2.=3.", "Expected the end, found `=`", 4),
+        ("1", "Expected `=` or `&`, found the end", 1),
+    ],
+)
+def test_parse_test_reports_malformed_tests(test, message, position):
+    spec = _parse_test(test)
+    assert spec.rank == -1
+    assert (spec.error, spec.position) == (message, position)
+
+
+def test_parse_test_compiles_both_sides():
+    spec = _parse_test("0=-2.$0- & 0/2.$1/1-")
+    assert spec.rank == 0
+    assert [e.text for e in spec.expectations] == ["-2.", "0-", "0/2.", "1/1-"]
+
+
+def test_verify_tests_fails_malformed_tests():
+    config = sample_config()
+    config["Test Pulls"] = [{"Pull": ["Hit", "Miss"], "Tests": ["1=2²."]}]
+    bag = TokenBag(False, None)
+    bag.import_config_json(config)
+    (passed, results) = bag.verify_tests()
+    assert not passed
+    assert results[0]["Error"] == (
+        "Expected a result of `.`, `-`, `+` or `^`, found `²` at position 3"
+    )
+
+
+@pytest.mark.parametrize("sums", [False, True])
+def test_odds_match_every_shuffle_of_the_bag(sums):
+    bag = small_bag(sums=sums)
+    odds = bag.odds()
+    expected = [
+        [dict.fromkeys(OUTCOMES, 0.0) for _ in range(bag.max_rank + 1)]
+        for _ in odds
+    ]
+    for pull, chance in every_pull(bag):
+        for cap, draws in enumerate(pull):
+            for rank, results in enumerate(draws["ranks"]):
+                for outcome in OUTCOMES:
+                    if results[outcome]:
+                        expected[cap][rank][outcome] += chance
+
+    for cap, draws in enumerate(odds):
+        for rank, chances in enumerate(draws["ranks"]):
+            for outcome in OUTCOMES:
+                assert chances[outcome] == pytest.approx(expected[cap][rank][outcome])
+
+
+def test_simulate_batches_count_like_single_pulls(monkeypatch):
+    np = pytest.importorskip("numpy")
+    bag = small_bag(max_draws=4)
+    batched = bag.simulate(20000, seed=3)
+
+    # Evaluate every pull of the same batch one at a time instead
+    def skip_all(_self, _tallies, the_pulls, *_args, **_kwargs):
+        return np.ones(len(the_pulls), bool)
+
+    monkeypatch.setattr(TokenBag, "_tally_batch", skip_all)
+    assert bag.simulate(20000, seed=3) == batched
+
+
+def test_simulate_without_numpy_matches_odds(monkeypatch):
+    monkeypatch.setattr(tokenbag, "np", None)
+    bag = small_bag()
+    n = 20000
+    results = bag.simulate(n, seed=3)
+    for cap, draws in enumerate(bag.odds()):
+        for rank, chances in enumerate(draws["ranks"]):
+            for outcome, count in zip(
+                OUTCOMES, results["counts"][cap][rank], strict=True
+            ):
+                assert count / n == pytest.approx(chances[outcome], abs=0.02)
+
+
+@pytest.mark.parametrize("numpy", [True, False])
+def test_sweep_rows_match_simulate(monkeypatch, numpy):
+    if not numpy:
+        monkeypatch.setattr(tokenbag, "np", None)
+    elif tokenbag.np is None:
+        pytest.skip("numpy is not installed")
+    bag = small_bag()
+    grid = {
+        "sums": [False, True],
+        "hit_ceil": [1, 2],
+        "hit_full": [1, 2],
+        "sum_ceil": [1, 3],
+        "sum_partial": [0, 1],
+        "max_draws": [2, 3],
+    }
+    results = bag.sweep(grid, 1000, seed=7)
+    assert len(results["rows"]) == 64
+    simulated = {}
+    for row in results["rows"]:
+        # The sweep draws its pulls at its largest draw cap
+        parameters = dict(row["parameters"], max_draws=3)
+        key = tuple(parameters.values())
+        if key not in simulated:
+            bag.configure_pull(**parameters)
+            simulated[key] = bag.simulate(1000, seed=7)["counts"]
+        counts = simulated[key][row["parameters"]["max_draws"] - 1]
+        assert row["rates"] == [[count / 1000 for count in rank] for rank in counts]
+
+
+def test_odds_key_follows_the_bag_and_rules():
+    key = small_bag().odds_key()
+    assert small_bag().odds_key() == key
+    assert small_bag(max_draws=2).odds_key() != key
+    assert small_bag(hit_ceil=5).odds_key() != key
+
+    bag = small_bag()
+    bag.pool["bags"][0].append(bag.pool["token_ids"]["Hit"])
+    assert bag.odds_key() != key
+
+
+def test_snapshot_is_reloaded_when_the_config_changes(tmp_path):
+    config = sample_config()
+    path = tmp_path / "bagpool.conf"
+    snapshots = tmp_path / "snapshots"
+    path.write_text(json.dumps(config))
+
+    def load() -> TokenBag:
+        bag = TokenBag(False, None)
+        bag.read_config_file(str(path), snapshot_dir=str(snapshots))
+        return bag
+
+    odds = load().odds()
+    assert list(snapshots.iterdir())
+    assert load().odds() == odds
+
+    config["Bag Pool"]["Base"]["Specification"][0]["Miss"] += 3
+    path.write_text(json.dumps(config))
+    changed = TokenBag(False, None)
+    changed.import_config_json(config)
+    assert changed.odds() != odds
+    assert load().odds() == changed.odds()
+
+
+def test_load_bag_pool_matches_loading_each_bag():
+    config = sample_config()
+    bags = TokenBag(False, None).load_bag_pool(config)
+    assert list(bags) == list(config["Bag Pool"])
+    for name, bag in bags.items():
+        alone = TokenBag(False, None)
+        alone.import_config_json(config, name)
+        assert bag.pull_rules() == alone.pull_rules()
+        assert bag.odds() == alone.odds()
+        assert bag.verify_tests() == alone.verify_tests()
@@ -1,12 +1,121 @@
 # __title__ = "TokenBag"
 # __version__ = '0.1.0'
+import contextlib
 import copy
+import functools
+import hashlib
+import itertools
 import json
-
-# import os
 import logging
+import math
+import os
+import pickle
 import random
+import time
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum
+from typing import NamedTuple
+
+try:
+    import numpy as np
+except ImportError:
+    # numpy is optional, simulate() falls back to evaluating pulls one by one
+    np = None
+
+# Loggers for the hot paths, so they aren't looked up on every pull. Debug
+# messages on these are only formatted when debug logging is enabled.
+_pull_logger = logging.getLogger("tokenbag._pull")
+_bag_sequence_logger = logging.getLogger("tokenbag._bag_sequence")
+_pull_one_logger = logging.getLogger("tokenbag.pull_one")
+
+# Pull outcomes, in the order they are counted by simulate()
+OUTCOMES = (
+    "failure",
+    "partial",
+    "full",
+    "crit",
+    "fortune-failure",
+    "fortune-partial",
+    "fortune-full",
+    "fortune-crit",
+)
+# configure_pull parameters that sweep() can vary. Parameters that change
+# which tokens are drawn, like bag_draws, can't share the same pulls.
+SWEEP_PARAMETERS = (
+    "max_draws",
+    "sums",
+    "hit_ceil_only_on_crit",
+    "hit_ceil",
+    "hit_full",
+    "hit_partial",
+    "miss_ceil",
+    "sum_ceil",
+    "sum_full",
+    "sum_partial",
+    "sum_floor",
+)
+
+# Version of the compiled pool snapshots, bump when their contents change
+SNAPSHOT_VERSION = 2
+# Version of the cached odds, bump when the way they are evaluated changes
+ODDS_VERSION = 1
+
+# Indexes of the base outcomes in OUTCOMES, the fortune ones follow them
+FAILURE, PARTIAL, FULL, CRIT = range(4)
+FORTUNE = 4
+
+# Keys of PullResult.to_dict(), and the subsets the pull methods return
+RESULT_KEYS = (
+    "rank",
+    "can-crit",
+    "hits",
+    "misses",
+    "sum",
+    "fortune-hits",
+    "fortune-misses",
+    "fortune-sum",
+    "crit",
+    "full",
+    "partial",
+    "failure",
+    "fortune-crit",
+    "fortune-full",
+    "fortune-partial",
+    "fortune-failure",
+    "pull-order",
+    "fortune-pull-order",
+    "costs",
+)
+_SUM_KEYS = tuple(
+    key
+    for key in RESULT_KEYS
+    if key not in ("hits", "misses", "fortune-hits", "fortune-misses")
+)
+_HIT_MISS_KEYS = tuple(
+    key for key in RESULT_KEYS if key not in ("sum", "fortune-sum")
+)
+_ACTION_KEYS = tuple(
+    key for key in RESULT_KEYS if key not in ("sum", "fortune-sum", "costs")
+)
+_BEFELL_KEYS = ("rank", "hits", "pull-order")
+# Columns of pull_many(), outcome codes being indexes into OUTCOMES
+PULL_COLUMNS = (
+    "hits",
+    "misses",
+    "sum",
+    "fortune-hits",
+    "fortune-misses",
+    "fortune-sum",
+    "can-crit",
+    "outcome",
+    "fortune-outcome",
+    "lost",
+    "taken",
+    "mitigated",
+)
+_RESISTANCE_KEYS = ("rank", "pull-order", "costs")
 
 
 class PullType(Enum):
@@ -15,10 +124,349 @@ class PullType(Enum):
     Befell = 3
 
 
+class Token(NamedTuple):
+    """A token definition compiled from the Token Pool
+
+    Hit and sum values are resolved per rank; ranks past the end of the
+    tuple take the last value. The flipped fields are fully specified from
+    the token itself when the token can't flip.
+    """
+
+    id: int
+    name: str
+    hit: tuple
+    sum: tuple
+    min_rank: int
+    can_be_stolen: bool
+    can_steal: bool
+    can_latch: bool
+    return_to_bag: bool
+    ends_draws: bool
+    enable_crit: int
+    can_flip: bool
+    flipped_hit: tuple
+    flipped_sum: tuple
+    flipped_min_rank: int
+    flipped_can_be_stolen: bool
+    flipped_can_latch: bool
+    flipped_ends_draws: bool
+
+
+class PullRules(NamedTuple):
+    """The pull configuration that a pull is evaluated with
+
+    Immutable, so a TokenBag can evaluate pulls with different rules at the
+    same time without changing its own configuration. See
+    TokenBag.pull_rules().
+    """
+
+    max_draws: int
+    ignores_ends_draws: bool
+    bag_draws: tuple
+    sums: bool
+    hit_ceil_only_on_crit: bool
+    hit_ceil: int
+    hit_full: int
+    hit_partial: int
+    miss_ceil: int
+    sum_ceil: int
+    sum_full: int
+    sum_partial: int
+    sum_floor: int
+    max_rank: int
+
+
+# The rules that Resistance and Befell pulls override
+_RESISTANCE_RULES = {
+    "max_draws": 3,
+    "miss_ceil": 30,
+    "hit_ceil": 30,
+    "ignores_ends_draws": True,
+    "sums": False,
+}
+
+
+class Expectation(NamedTuple):
+    """One expected result of a rank test, compiled from the Tests DSL
+
+    The value is the sum for sum tests, or the hits for hit/miss tests. The
+    result is one of `.`, `-`, `+` or `^`.
+    """
+
+    sums: bool
+    fortune: bool
+    value: int
+    misses: int
+    result: str
+    # The text of this side of the test, for reporting failures
+    text: str
+
+
+class TestSpec(NamedTuple):
+    """A rank test compiled from the Tests DSL
+
+    Malformed tests have no expectations, and the error and the position of
+    the problem in the original text instead.
+    """
+
+    text: str
+    rank: int
+    expectations: tuple
+    error: str = ""
+    position: int = -1
+
+
+class PullResult:
+    """The results of a pull for a single rank
+
+    The base and fortune results are stored as indexes into OUTCOMES. The
+    pull orders are only recorded when asked for, otherwise they're None.
+    """
+
+    __slots__ = (
+        "rank",
+        "can_crit",
+        "hits",
+        "misses",
+        "sum",
+        "fortune_hits",
+        "fortune_misses",
+        "fortune_sum",
+        "outcome",
+        "fortune_outcome",
+        "pull_order",
+        "fortune_pull_order",
+        "lost",
+        "taken",
+        "mitigated",
+    )
+
+    def __init__(self, rank: int, orders: bool = False) -> None:
+        self.rank = rank
+        self.can_crit = False
+        self.hits = 0
+        self.misses = 0
+        self.sum = 0
+        self.fortune_hits = 0
+        self.fortune_misses = 0
+        self.fortune_sum = 0
+        self.outcome = FAILURE
+        self.fortune_outcome = FORTUNE + FAILURE
+        self.pull_order = [] if orders else None
+        self.fortune_pull_order = [] if orders else None
+        # Resistance costs
+        self.lost = 0
+        self.taken = 0
+        self.mitigated = 0
+
+    def copy(self) -> "PullResult":
+        copied = PullResult.__new__(PullResult)
+        copied.rank = self.rank
+        copied.can_crit = self.can_crit
+        copied.hits = self.hits
+        copied.misses = self.misses
+        copied.sum = self.sum
+        copied.fortune_hits = self.fortune_hits
+        copied.fortune_misses = self.fortune_misses
+        copied.fortune_sum = self.fortune_sum
+        copied.outcome = self.outcome
+        copied.fortune_outcome = self.fortune_outcome
+        copied.pull_order = self.pull_order
+        copied.fortune_pull_order = self.fortune_pull_order
+        if self.pull_order is not None:
+            copied.pull_order = list(self.pull_order)
+            copied.fortune_pull_order = list(self.fortune_pull_order)
+        copied.lost = self.lost
+        copied.taken = self.taken
+        copied.mitigated = self.mitigated
+        return copied
+
+    def to_dict(self, keys: tuple = RESULT_KEYS) -> dict:
+        """Return the results as a dict with the given keys of RESULT_KEYS"""
+        values = {
+            "rank": self.rank,
+            "can-crit": "Y" if self.can_crit else "-",
+            "hits": self.hits,
+            "misses": self.misses,
+            "sum": self.sum,
+            "fortune-hits": self.fortune_hits,
+            "fortune-misses": self.fortune_misses,
+            "fortune-sum": self.fortune_sum,
+            "crit": self.outcome == CRIT,
+            "full": self.outcome == FULL,
+            "partial": self.outcome == PARTIAL,
+            "failure": self.outcome == FAILURE,
+            "fortune-crit": self.fortune_outcome == FORTUNE + CRIT,
+            "fortune-full": self.fortune_outcome == FORTUNE + FULL,
+            "fortune-partial": self.fortune_outcome == FORTUNE + PARTIAL,
+            "fortune-failure": self.fortune_outcome == FORTUNE + FAILURE,
+            "pull-order": list(self.pull_order or []),
+            "fortune-pull-order": list(self.fortune_pull_order or []),
+            "costs": {
+                "lost": self.lost,
+                "taken": self.taken,
+                "mitigated": self.mitigated,
+            },
+        }
+        return {key: values[key] for key in keys}
+
+
+_MASK64 = (1 << 64) - 1
+
+
+def _mix64(z: int) -> int:
+    """The splitmix64 finalizer, mixing the bits of a 64 bit integer"""
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & _MASK64
+    return z ^ (z >> 31)
+
+
+class PullStream:
+    """The random stream of one pull of a seeded run, see TokenBag.spawn
+
+    A splitmix64 generator, which is much cheaper to start than seeding a
+    random.Random for the few draws of a single pull. randrange(n) maps the
+    64 bit output onto the range by multiplying, so its bias is at most
+    n / 2**64.
+    """
+
+    __slots__ = ("state",)
+
+    def __init__(self, seed: int, index: int) -> None:
+        self.state = _mix64(_mix64(seed & _MASK64) ^ index)
+
+    def randrange(self, n: int) -> int:
+        state = self.state = (self.state + 0x9E3779B97F4A7C15) & _MASK64
+        return (_mix64(state) * n) >> 64
+
+
+class PullStats:
+    """Counts and times the work done evaluating pulls, see enable_stats"""
+
+    __slots__ = (
+        "shuffles",
+        "shuffle_seconds",
+        "evaluations",
+        "evaluation_seconds",
+        "tokens",
+        "steals",
+        "ceilings",
+        "ends_draws",
+    )
+
+    def __init__(self) -> None:
+        # Replayable pulls drawn from the bag(s), and the time taken
+        self.shuffles = 0
+        self.shuffle_seconds = 0.0
+        # Pulls evaluated for a rank, and the time taken
+        self.evaluations = 0
+        self.evaluation_seconds = 0.0
+        # Tokens evaluated, and tokens stolen by them
+        self.tokens = 0
+        self.steals = 0
+        # Pulls stopped early by the hit/miss ceilings or sum ceiling/floor
+        self.ceilings = 0
+        # Tokens that ended the base draw
+        self.ends_draws = 0
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def merge(self, other: "PullStats") -> None:
+        """Add the counts and times of other, such as from a worker process"""
+        for name in self.__slots__:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+
+
+class OddsCache:
+    """Cache of TokenBag.odds() results, keyed by TokenBag.odds_key()
+
+    Keeps the most recently used maxsize results in memory. If a directory
+    is given the results are also saved there as json files, removing the
+    least recently used files once they take up more than max_bytes.
+    """
+
+    def __init__(
+        self, maxsize: int = 128, directory: str = "", max_bytes: int = 64 << 20
+    ) -> None:
+        self.maxsize = maxsize
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key: str) -> list | None:
+        """Return a copy of the cached odds, or None if they aren't cached"""
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return copy.deepcopy(self.entries[key])
+        if not self.directory:
+            return None
+        try:
+            with open(self._path(key)) as f:
+                odds = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # Mark the file as recently used for eviction, if it can be
+        with contextlib.suppress(OSError):
+            os.utime(self._path(key))
+        self._remember(key, odds)
+        return copy.deepcopy(odds)
+
+    def put(self, key: str, odds: list) -> None:
+        """Cache a copy of the odds
+
+        A directory that can't be written to only keeps the odds in memory.
+        """
+        odds = copy.deepcopy(odds)
+        self._remember(key, odds)
+        if not self.directory:
+            return
+        path = self._path(key)
+        # Write to a temporary file first so readers never see a partial one
+        partial = f"{path}.{os.getpid()}"
+        try:
+            with open(partial, "w") as f:
+                json.dump(odds, f)
+            os.replace(partial, path)
+        except OSError:
+            with contextlib.suppress(OSError):
+                os.remove(partial)
+            return
+        with contextlib.suppress(OSError):
+            self._evict_files()
+
+    def _remember(self, key: str, odds: list) -> None:
+        self.entries[key] = odds
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def _evict_files(self) -> None:
+        files = []
+        for entry in os.scandir(self.directory):
+            # Other processes sharing the directory may remove files under us
+            if entry.name.endswith(".json"):
+                with contextlib.suppress(OSError):
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            with contextlib.suppress(OSError):
+                os.remove(path)
+            total -= size
+
+
 class TokenBag:
-    def __init__(self, debug: bool, log: str) -> None:
+    def __init__(self, debug: bool, log: str, rng=None) -> None:
         self.config_filename = ""
-        self.pool = {"bags": [], "tokens": {}}
+        self.pool = {"bags": [], "tokens": [], "token_ids": {}, "hit_miss_sums": {}}
         self.test_pulls = []
         self.debug = debug
         self.logfile = log
@@ -50,6 +498,13 @@ class TokenBag:
         # auto calculated or overridden by configure_pool
         self.max_rank = 3
 
+        # Random number generator(s) for shuffling the bag(s), see set_rng
+        self.set_rng(rng)
+        # PullStats when instrumentation is enabled, see enable_stats
+        self.stats = None
+        # OddsCache to reuse the results of odds() from, if any
+        self.odds_cache = None
+
         if not debug:
             logging.basicConfig(
                 format="%(levelname)s: %(message)s",
@@ -66,13 +521,102 @@ class TokenBag:
             )
 
     def read_config_file(
-        self, config_filename: str, bag_name: str = "", tests: bool = True
+        self,
+        config_filename: str,
+        bag_name: str = "",
+        tests: bool = True,
+        snapshot_dir: str = "",
     ) -> None:
-        """Read configuration from a json text file"""
+        """Read configuration from a json text file
+
+        With a snapshot_dir the compiled pool is saved there, and loaded
+        instead of parsing the config again for as long as it is unchanged.
+        """
         self.config_filename = config_filename
-        with open(config_filename) as f:
-            config = json.load(f)
-            self._initialize_pool(config, bag_name, tests)
+        snapshot = ""
+        if snapshot_dir:
+            snapshot = self._snapshot_path(
+                config_filename, bag_name, tests, snapshot_dir
+            )
+            if self._load_snapshot(snapshot, config_filename):
+                return
+
+        with open(config_filename, "rb") as f:
+            data = f.read()
+        config = json.loads(data)
+        test_pulls = len(self.test_pulls)
+        self._initialize_pool(config, bag_name, tests)
+        if snapshot and self.pool["bags"]:
+            self._save_snapshot(snapshot, config_filename, data, test_pulls)
+
+    def _snapshot_path(
+        self, config_filename: str, bag_name: str, tests: bool, snapshot_dir: str
+    ) -> str:
+        """Return the snapshot file for loading a config with these settings"""
+        key = json.dumps(
+            [
+                os.path.abspath(config_filename),
+                bag_name,
+                tests,
+                self._pull_parameters(),
+                self.max_rank,
+            ],
+            sort_keys=True,
+        )
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        return os.path.join(snapshot_dir, f"{digest}.pickle")
+
+    def _load_snapshot(self, snapshot: str, config_filename: str) -> bool:
+        """Load the compiled pool from a snapshot, if it matches the config"""
+        logger = logging.getLogger("tokenbag._load_snapshot")
+        try:
+            with open(snapshot, "rb") as f:
+                saved = pickle.load(f)
+            if saved["version"] != SNAPSHOT_VERSION:
+                return False
+            stat = os.stat(config_filename)
+            if (stat.st_mtime_ns, stat.st_size) != (saved["mtime_ns"], saved["size"]):
+                # Only touched files still match on their contents
+                with open(config_filename, "rb") as f:
+                    if hashlib.sha256(f.read()).hexdigest() != saved["sha256"]:
+                        return False
+        except (OSError, EOFError, KeyError, pickle.UnpicklingError) as e:
+            logger.debug("Not loading snapshot `%s`: %s", snapshot, e)
+            return False
+
+        self.configure_pull(**saved["parameters"])
+        self.pool = {
+            "bags": saved["bags"],
+            "tokens": saved["tokens"],
+            "token_ids": saved["token_ids"],
+            "hit_miss_sums": {},
+        }
+        self.test_pulls.extend(saved["test_pulls"])
+        logger.debug("Loaded snapshot `%s`", snapshot)
+        return True
+
+    def _save_snapshot(
+        self, snapshot: str, config_filename: str, data: bytes, test_pulls: int
+    ) -> None:
+        """Save the compiled pool to a snapshot of the config"""
+        stat = os.stat(config_filename)
+        saved = {
+            "version": SNAPSHOT_VERSION,
+            "mtime_ns": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "sha256": hashlib.sha256(data).hexdigest(),
+            "parameters": {**self._pull_parameters(), "max_rank": self.max_rank},
+            "bags": self.pool["bags"],
+            "tokens": self.pool["tokens"],
+            "token_ids": self.pool["token_ids"],
+            "test_pulls": self.test_pulls[test_pulls:],
+        }
+        os.makedirs(os.path.dirname(snapshot), exist_ok=True)
+        # Write to a temporary file first so readers never see a partial one
+        partial = f"{snapshot}.{os.getpid()}"
+        with open(partial, "wb") as f:
+            pickle.dump(saved, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(partial, snapshot)
 
     def import_config_json(
         self, config_json: dict, bag_name: str = "", tests: bool = True
@@ -85,23 +629,7 @@ class TokenBag:
         # logger = logging.getLogger(__name__)
 
         # Respecify defaults to ensure they exist
-        parameters = {
-            "bag_name": self.bag_name,
-            "ranks": self.ranks,
-            "max_draws": self.max_draws,
-            "ignores_ends_draws": self.ignores_ends_draws,
-            "sums": self.sums,
-            "hit_ceil_only_on_crit": self.hit_ceil_only_on_crit,
-            "hit_ceil": self.hit_ceil,
-            "hit_full": self.hit_full,
-            "hit_partial": self.hit_partial,
-            "miss_ceil": self.miss_ceil,
-            "sum_ceil": self.sum_ceil,
-            "sum_full": self.sum_full,
-            "sum_partial": self.sum_partial,
-            "sum_floor": self.sum_floor,
-            "bag_draws": self.bag_draws,
-        }
+        parameters = self._pull_parameters()
         # Then update them from the passed in kwargs
         parameters.update(kwargs)
 
@@ -134,6 +662,57 @@ class TokenBag:
         # logger.debug("Updated configuration:")
         # logger.debug(vars(self))
 
+    def _pull_parameters(self) -> dict:
+        """Return the parameters that configure_pull sets"""
+        return {
+            "bag_name": self.bag_name,
+            "ranks": self.ranks,
+            "max_draws": self.max_draws,
+            "ignores_ends_draws": self.ignores_ends_draws,
+            "sums": self.sums,
+            "hit_ceil_only_on_crit": self.hit_ceil_only_on_crit,
+            "hit_ceil": self.hit_ceil,
+            "hit_full": self.hit_full,
+            "hit_partial": self.hit_partial,
+            "miss_ceil": self.miss_ceil,
+            "sum_ceil": self.sum_ceil,
+            "sum_full": self.sum_full,
+            "sum_partial": self.sum_partial,
+            "sum_floor": self.sum_floor,
+            "bag_draws": self.bag_draws,
+        }
+
+    def pull_rules(self, **kwargs) -> PullRules:
+        """Return the current pull configuration as PullRules
+
+        kwargs override the configuration for just these rules, leaving the
+        TokenBag unchanged. Parameters that aren't rules are ignored, like
+        they are by configure_pull.
+        """
+        parameters = {
+            "max_draws": self.max_draws,
+            "ignores_ends_draws": self.ignores_ends_draws,
+            "bag_draws": self.bag_draws,
+            "sums": self.sums,
+            "hit_ceil_only_on_crit": self.hit_ceil_only_on_crit,
+            "hit_ceil": self.hit_ceil,
+            "hit_full": self.hit_full,
+            "hit_partial": self.hit_partial,
+            "miss_ceil": self.miss_ceil,
+            "sum_ceil": self.sum_ceil,
+            "sum_full": self.sum_full,
+            "sum_partial": self.sum_partial,
+            "sum_floor": self.sum_floor,
+            "max_rank": self.max_rank,
+        }
+        parameters.update(
+            (name, value) for name, value in kwargs.items() if name in parameters
+        )
+        parameters["bag_draws"] = tuple(
+            tuple(draws) for draws in parameters["bag_draws"]
+        )
+        return PullRules(**parameters)
+
     def _initialize_pool(
         self, config: dict, bag_name: str = "", tests: bool = True
     ) -> None:
@@ -159,10 +738,56 @@ class TokenBag:
             logger.error("Requested bag `%s` not found in Bag Pool", self.bag_name)
             return
 
-        self.pool["bags"].clear()
-        self.pool["tokens"].clear()
-        max_rank = 0
+        # A new pool, as bags from load_bag_pool may still share the old one
+        self.pool = {"bags": [], "tokens": [], "token_ids": {}, "hit_miss_sums": {}}
+
+        blank_token = self._add_blank_token(config)
+        bag_spec = self._bag_spec(config, self.bag_name)
+        if tests and "Test Pulls" in config:
+            bag_spec.append(self._add_test_pulls(config))
+        self._compile_bags(config, bag_spec, blank_token)
+        logger.debug("Final configuration:")
+        logger.debug(vars(self))
+
+    def load_bag_pool(self, config: dict, tests: bool = True) -> dict:
+        """Compile every bag of the Bag Pool, returning a TokenBag for each
+
+        The returned TokenBags share this one's compiled Token Pool, and hold
+        their own bags, Test Pulls and pull configuration: the top level Config
+        with the Config of their bag applied over it. Loading another config
+        into any of them, or into this one, gives it a new pool rather than
+        clearing the shared one.
+        """
+        logger = logging.getLogger("tokenbag._initialize_pool")
+        if "Bag Pool" not in config or "Token Pool" not in config:
+            logger.error("No `Bag Pool` (or no `Token Pool`) specified in config")
+            return {}
+
+        if "Config" in config:
+            self.configure_pull(**(config["Config"]))
+        # A new pool, as bags from load_bag_pool may still share the old one
+        self.pool = {"bags": [], "tokens": [], "token_ids": {}, "hit_miss_sums": {}}
 
+        blank_token = self._add_blank_token(config)
+        test_bag = None
+        if tests and "Test Pulls" in config:
+            test_bag = self._add_test_pulls(config)
+        bags = {}
+        for bag_name in config["Bag Pool"]:
+            bag = copy.copy(self)
+            bag.pool = dict(self.pool, bags=[])
+            bag.test_pulls = list(self.test_pulls)
+            bag.bag_name = bag_name
+            bag_spec = bag._bag_spec(config, bag_name)
+            if test_bag is not None:
+                bag_spec.append(test_bag)
+            bag._compile_bags(config, bag_spec, blank_token)
+            bags[bag_name] = bag
+        return bags
+
+    def _add_blank_token(self, config: dict) -> dict:
+        """Add the Blank token, returning the defaults for every other token"""
+        logger = logging.getLogger("tokenbag._initialize_pool")
         # Make the default token entry
         blank_token = {
             "Sum Value": 0,
@@ -180,37 +805,50 @@ class TokenBag:
         # Update the default if it is specified
         if "Blank" in config["Token Pool"]:
             blank_token.update(config["Token Pool"]["Blank"])
-        self.pool["tokens"]["Blank"] = blank_token
+        self._add_token("Blank", blank_token)
         logger.debug("Generated Default Blank Token:")
         logger.debug(blank_token)
+        return blank_token
 
-        bag_spec = []
-        bag_top = config["Bag Pool"][self.bag_name]
+    def _bag_spec(self, config: dict, bag_name: str) -> list:
+        """Return the token counts of each bag, applying the bag's Config"""
+        bag_top = config["Bag Pool"][bag_name]
         if isinstance(bag_top, list):
-            bag_spec = bag_top
-        else:
-            if "Config" in bag_top:
-                self.configure_pull(**(bag_top["Config"]))
-            if "Specification" in bag_top:
-                bag_spec = bag_top["Specification"]
+            return list(bag_top)
+        if "Config" in bag_top:
+            self.configure_pull(**(bag_top["Config"]))
+        return list(bag_top.get("Specification", []))
 
+    def _add_test_pulls(self, config: dict) -> dict:
+        """Compile the Test Pulls, returning a bag of every token they use"""
+        logger = logging.getLogger("tokenbag._initialize_pool")
         # Build a fake tests bag, to ensure all the test tokens are available
-        if "Test Pulls" in config:
-            logger.debug(
-                f"Found {len(config['Test Pulls'])} Test Pulls in config."
-                f" Tests: {tests}"
-            )
-        if tests and "Test Pulls" in config:
-            test_bag = {}
-            for test in config["Test Pulls"]:
-                if "Pull" not in test or "Tests" not in test:
-                    continue
-                self.test_pulls.append(copy.deepcopy(test))
-                for draw in test["Pull"]:
-                    if draw not in test_bag:
-                        test_bag[draw] = 1
-            bag_spec.append(test_bag)
-
+        test_bag = {}
+        logger.debug(f"Found {len(config['Test Pulls'])} Test Pulls in config.")
+        for test in config["Test Pulls"]:
+            if "Pull" not in test or "Tests" not in test:
+                continue
+            test = copy.deepcopy(test)
+            test["Compiled Tests"] = [_parse_test(t) for t in test["Tests"]]
+            for spec in test["Compiled Tests"]:
+                if spec.error:
+                    logger.error(
+                        "Test `%s` of %s: %s at position %d",
+                        spec.text,
+                        test["Pull"],
+                        spec.error,
+                        spec.position,
+                    )
+            self.test_pulls.append(test)
+            for draw in test["Pull"]:
+                if draw not in test_bag:
+                    test_bag[draw] = 1
+        return test_bag
+
+    def _compile_bags(self, config: dict, bag_spec: list, blank_token: dict) -> None:
+        """Fill the bags from their token counts, compiling any new tokens"""
+        logger = logging.getLogger("tokenbag._initialize_pool")
+        max_rank = 0
         for bag_def in bag_spec:
             bag_number = len(self.pool["bags"]) + 1
             logger.debug(
@@ -219,68 +857,107 @@ class TokenBag:
                 self.bag_name,
                 bag_number,
             )
-            sub_bag = []
+            sub_bag = array("i")
             for token_def in bag_def:
                 if token_def not in config["Token Pool"]:
                     logger.debug(
                         "Couldn't find `%s` token definition in Token Pool, skipping",
-                        len(token_def),
                         token_def,
                     )
                     continue
                 logger.debug("Adding %d `%s` tokens", bag_def[token_def], token_def)
-                # Add the correct number of this token to the bag
-                tokens = [token_def for x in range(bag_def[token_def])]
-                sub_bag.extend(tokens)
-
-                # Add the token definition to the Token Pool
-                token = json.loads(json.dumps(blank_token))
-                conf_token = config["Token Pool"][token_def]
-                if "Hit Value" not in conf_token and "Sum Value" in conf_token:
-                    conf_token["Hit Value"] = copy.deepcopy(conf_token["Sum Value"])
-                elif "Sum Value" not in conf_token and "Hit Value" in conf_token:
-                    conf_token["Sum Value"] = copy.deepcopy(conf_token["Hit Value"])
-                token.update(conf_token)
-                max_rank = max(max_rank, token["Min Rank"])
-
-                if token["Can Flip"]:
-                    # Add in the fully specified Flipped state,
-                    # defaulted to the initial token state
-                    fToken = json.loads(json.dumps(token))
-                    if (
-                        "Hit Value" not in conf_token["Flipped"]
-                        and "Sum Value" in conf_token["Flipped"]
-                    ):
-                        conf_token["Flipped"]["Hit Value"] = copy.deepcopy(
-                            conf_token["Flipped"]["Sum Value"]
-                        )
-                    elif (
-                        "Sum Value" not in conf_token["Flipped"]
-                        and "Hit Value" in conf_token["Flipped"]
-                    ):
-                        conf_token["Flipped"]["Sum Value"] = copy.deepcopy(
-                            conf_token["Flipped"]["Hit Value"]
-                        )
 
-                    fToken.update(token["Flipped"])
-                    # These options are not supported after flipping
-                    fToken["Can Flip"] = False
-                    fToken["Can Steal"] = False
-                    # fToken["Can Be Stolen"] = False
-                    del fToken["Flipped"]
-                    token["Flipped"].update(fToken)
-                    max_rank = max(max_rank, token["Flipped"]["Min Rank"])
-
-                if token_def not in self.pool["tokens"]:
-                    self.pool["tokens"][token_def] = {}
-                self.pool["tokens"][token_def].update(token)
-                logger.debug("Writing token `%s`", token_def)
-                logger.debug(token)
+                if token_def in self.pool["token_ids"]:
+                    # Already compiled for another bag
+                    token_id = self.pool["token_ids"][token_def]
+                else:
+                    token_id = self._compile_token(config, token_def, blank_token)
+                compiled = self.pool["tokens"][token_id]
+                max_rank = max(max_rank, compiled.min_rank, compiled.flipped_min_rank)
+                sub_bag.extend([token_id] * bag_def[token_def])
             self.pool["bags"].append(sub_bag)
             # Update the bag with the max rank found on a token
             self.max_rank = max_rank
-        logger.debug("Final configuration:")
-        logger.debug(vars(self))
+
+    def _compile_token(self, config: dict, token_def: str, blank_token: dict) -> int:
+        """Compile a token of the Token Pool, returning its id"""
+        logger = logging.getLogger("tokenbag._initialize_pool")
+        # Fill in the token definition from the default token
+        token = dict(blank_token)
+        conf_token = dict(config["Token Pool"][token_def])
+        if "Hit Value" not in conf_token and "Sum Value" in conf_token:
+            conf_token["Hit Value"] = conf_token["Sum Value"]
+        elif "Sum Value" not in conf_token and "Hit Value" in conf_token:
+            conf_token["Sum Value"] = conf_token["Hit Value"]
+        token.update(conf_token)
+
+        if token["Can Flip"]:
+            # Add in the fully specified Flipped state,
+            # defaulted to the initial token state
+            conf_flipped = dict(token["Flipped"])
+            if "Hit Value" not in conf_flipped and "Sum Value" in conf_flipped:
+                conf_flipped["Hit Value"] = conf_flipped["Sum Value"]
+            elif "Sum Value" not in conf_flipped and "Hit Value" in conf_flipped:
+                conf_flipped["Sum Value"] = conf_flipped["Hit Value"]
+
+            fToken = dict(token)
+            fToken.update(conf_flipped)
+            # These options are not supported after flipping
+            fToken["Can Flip"] = False
+            fToken["Can Steal"] = False
+            # fToken["Can Be Stolen"] = False
+            del fToken["Flipped"]
+            token["Flipped"] = fToken
+
+        # Add the compiled token to the Token Pool
+        token_id = self._add_token(token_def, token)
+        logger.debug("Writing token `%s`", token_def)
+        logger.debug(self.pool["tokens"][token_id])
+        return token_id
+
+    def _add_token(self, name: str, token: dict) -> int:
+        """Compile a fully specified token definition into the Token Pool"""
+        token_id = self.pool["token_ids"].setdefault(name, len(self.pool["tokens"]))
+        flipped = token["Flipped"] if token["Can Flip"] else token
+        compiled = Token(
+            id=token_id,
+            name=name,
+            hit=self._rank_values(token["Hit Value"], token["Min Rank"]),
+            sum=self._rank_values(token["Sum Value"], token["Min Rank"]),
+            min_rank=token["Min Rank"],
+            can_be_stolen=token["Can Be Stolen"],
+            can_steal=token["Can Steal"],
+            can_latch=token["Can Latch"],
+            return_to_bag=token["Return to Bag"],
+            ends_draws=token["Ends Draws"],
+            enable_crit=token["Enable Crit"],
+            can_flip=token["Can Flip"],
+            flipped_hit=self._rank_values(flipped["Hit Value"], flipped["Min Rank"]),
+            flipped_sum=self._rank_values(flipped["Sum Value"], flipped["Min Rank"]),
+            flipped_min_rank=flipped["Min Rank"],
+            flipped_can_be_stolen=flipped["Can Be Stolen"],
+            flipped_can_latch=flipped["Can Latch"],
+            flipped_ends_draws=flipped["Ends Draws"],
+        )
+        if token_id < len(self.pool["tokens"]):
+            self.pool["tokens"][token_id] = compiled
+        else:
+            self.pool["tokens"].append(compiled)
+        return token_id
+
+    def _rank_values(self, value, minRank: int) -> tuple:
+        """Resolve a (possibly rank scaled) value into a value per rank"""
+        if not isinstance(value, list):
+            return (value,)
+        # Possible i values: 0, 1, 2 with four ranks 0-3
+        # 0 = 1 - 1;
+        # 1 = 2 - 1; 0 = 2 - 2;
+        # 2 = 3 - 1; 1 = 3 - 2; 0 = 3 - 3
+        # Ranks past the end of the list take the last value
+        return tuple(
+            value[max(rank - minRank, -len(value))]
+            for rank in range(minRank + len(value))
+        )
 
     def get_pool(self) -> dict:
         """Return the stored bag and token pools"""
@@ -292,616 +969,1547 @@ class TokenBag:
             return ""
         return self.ranks[rank]
 
-    def _replayable_pull(self) -> list:
-        """Return a list of token names as the pull from the bag(s)"""
-        the_pull = []
-        logger = logging.getLogger("tokenbag._replayable_pull")
-
-        # Setup the original shuffled bags
-        the_bags = {}
+    def set_rng(self, rng=None) -> None:
+        """Set the random number generator used to shuffle the bag(s)
+
+        rng can be a random.Random or numpy Generator to shuffle every pull
+        with, or an integer seed. With a seed each pull gets its own stream
+        derived from the seed and the pull's index, so any pull of a run can
+        be regenerated with jump() or spawn(). None uses an unseeded
+        random.Random.
+        """
+        self.seed = None
+        # Indexes of the pulls of a seeded run, shared by concurrent callers
+        self.pull_indexes = itertools.count()
+        if rng is None:
+            self.rng = random.Random()
+        elif isinstance(rng, int):
+            self.seed = rng
+            self.rng = None
+        else:
+            self.rng = rng
+
+    def enable_stats(self) -> PullStats:
+        """Start counting the work done by pulls, returning the PullStats
+
+        Only pulls evaluated one at a time are counted, not the numpy batches
+        of simulate(), nor the internal pulls of odds() and verify_tests().
+        The pulls of simulate_parallel() workers are added up. Use
+        disable_stats() to stop counting.
+        """
+        self.stats = PullStats()
+        return self.stats
+
+    def disable_stats(self) -> None:
+        """Stop counting the work done by pulls"""
+        self.stats = None
+
+    def jump(self, index: int) -> None:
+        """Make the next pull regenerate pull index of the seeded run"""
+        if self.seed is None:
+            raise ValueError("Regenerating a pull requires an integer seed")
+        self.pull_indexes = itertools.count(index)
+
+    def spawn(self, index: int) -> PullStream:
+        """Return the random stream for pull index of the seeded run"""
+        if self.seed is None:
+            raise ValueError("Regenerating a pull requires an integer seed")
+        return PullStream(self.seed, index)
+
+    def _draw_cap(self, rules: PullRules) -> int:
+        """Return the most tokens a pull draws, max_draws or 0 for unlimited"""
+        if rules.max_draws > 0:
+            return rules.max_draws
+        # Unlimited pulls draw until the bag(s) run out of tokens
+        bags = {bag for bag, _ in rules.bag_draws if bag < len(self.pool["bags"])}
+        return sum(len(self.pool["bags"][bag]) for bag in bags)
+
+    def _bag_sequence(self, rules: PullRules) -> list:
+        """Return the bag index to draw from for each draw of a pull"""
+        max_draws = self._draw_cap(rules)
         bag_pulls = []
         draw_again = True
         draw_count = 0
         while draw_again:
-            for bag, draws in self.bag_draws:
+            for bag, draws in rules.bag_draws:
                 if bag >= len(self.pool["bags"]):
-                    logger.error("Requested bag index `%d` not found in Bag Pool", bag)
-                    return the_pull
-
-                # Add a shuffled bag to draw from
-                if bag not in the_bags:
-                    the_bags[bag] = list(range(len(self.pool["bags"][bag])))
-                    random.shuffle(the_bags[bag])
+                    _bag_sequence_logger.error(
+                        "Requested bag index `%d` not found in Bag Pool", bag
+                    )
+                    return []
 
                 # Configure the draw(s) from the bag(s)
                 for _ in range(0, draws):
-                    if draw_count >= self.max_draws:
+                    if draw_count >= max_draws:
                         draw_again = False
                         break
                     bag_pulls.append(bag)
                     draw_count += 1
+        return bag_pulls
+
+    def _ends_pull(self, token: Token, rules: PullRules) -> bool:
+        """Check if drawing this token ends the replayable pull"""
+        flippedEnd = (token.can_flip and token.flipped_ends_draws) or (
+            not token.can_flip and token.ends_draws
+        )
+        return bool(flippedEnd and not rules.ignores_ends_draws)
+
+    def _replayable_pull(self, rules: PullRules, rng=None) -> list:
+        """Return a list of token ids as the pull from the bag(s)"""
+        stats = self.stats
+        if stats is not None:
+            started = time.perf_counter()
+        if rng is None:
+            rng = self.rng
+        if rng is None:
+            rng = self.spawn(next(self.pull_indexes))
+        # random.Random or numpy Generator
+        randrange = getattr(rng, "randrange", None) or rng.integers
+        the_pull = []
+
+        # Draw each token with a partial Fisher-Yates shuffle of the bag, only
+        # tracking the positions that have been swapped. The tokens still in
+        # a bag are at positions [0, size), and drawn tokens are swapped past
+        # the end of them.
+        bag_pulls = self._bag_sequence(rules)
+        sizes = {bag: len(self.pool["bags"][bag]) for bag in bag_pulls}
+        swaps = {bag: {} for bag in bag_pulls}
 
         # Now get the token associated for each draw from the corresponding bag
         for bag in bag_pulls:
-            # Get the token name & definition
-            p = the_bags[bag].pop(0)
-            token_name = self.pool["bags"][bag][p]
+            size = sizes[bag]
+            if not size:
+                # The bag is empty, so nothing more can be drawn
+                break
 
-            if token_name not in self.pool["tokens"]:
-                logger.error("Requested token `%s` not found in Token Pool", token_name)
-                return the_pull
+            # Get the token id & definition
+            swapped = swaps[bag]
+            j = randrange(size)
+            last = size - 1
+            p = swapped.get(j, j)
+            swapped[j] = swapped.get(last, last)
+            swapped[last] = p
+            token_id = self.pool["bags"][bag][p]
 
-            # We're returning the list of token names, so save it
-            the_pull.append(token_name)
+            # We're returning the list of token ids, so save it
+            the_pull.append(token_id)
 
             # Check for abilities that alter the bag and shuffle order
-            token = self.pool["tokens"][token_name]
+            token = self.pool["tokens"][token_id]
 
-            if token["Return to Bag"]:
-                # Add this back to the bag and re-shuffle
-                the_bags[bag].append(p)
-                random.shuffle(the_bags[bag])
+            if not token.return_to_bag:
+                sizes[bag] = last
+            # else it stays in the bag, so it can be drawn again
 
             # Check if token ends draws
-            flippedEnd = (token["Can Flip"] and token["Flipped"]["Ends Draws"]) or (
-                not token["Can Flip"] and token["Ends Draws"]
-            )
-            if flippedEnd and not self.ignores_ends_draws:
+            if self._ends_pull(token, rules):
                 break
 
+        if stats is not None:
+            stats.shuffles += 1
+            stats.shuffle_seconds += time.perf_counter() - started
         return the_pull
 
-    def _getHitMissSum(self, rank, minRank, inHit, inSum):
-        """Handle navigating the hit/miss/sum values"""
+    def _getHitMissSum(self, rank, inHit, inSum, sums):
+        """Handle navigating the per rank hit/miss/sum values"""
         vHit = 0
         vMiss = 0
         vSum = 0
 
-        if not self.sums:
-            vHitMiss = 0
-            if not isinstance(inHit, list):
-                vHitMiss = inHit
-            else:
-                # Possible i values: 0, 1, 2 with four ranks 0-3
-                # 0 = 1 - 1;
-                # 1 = 2 - 1; 0 = 2 - 2;
-                # 2 = 3 - 1; 1 = 3 - 2; 0 = 3 - 3
-                i = rank - minRank
-                vHitMiss = inHit[-1] if i >= len(inHit) else inHit[i]
+        if not sums:
+            # If we want a rank past the end of the values, take the last
+            vHitMiss = inHit[rank] if rank < len(inHit) else inHit[-1]
             if vHitMiss > 0:
                 vHit += vHitMiss
             else:
                 vMiss += vHitMiss
         else:
             # Handle Sums
-            if not isinstance(inSum, list):
-                vSum += inSum
-            else:
-                # Handle looking up Min Rank to see where to start the value
-                i = rank - minRank
-                # If we want a position not in the list, take the last
-                # Otherwise take the requested position
-                vSum += inSum[-1] if i >= len(inSum) else inSum[i]
+            vSum += inSum[rank] if rank < len(inSum) else inSum[-1]
 
         return (vHit, abs(vMiss), vSum)
 
-    def _pull(self, rank: int, the_pull: list, resistance: bool) -> dict:
-        """Evaluate a replayable pull via token names for a given rank"""
-        logger = logging.getLogger("tokenbag._pull")
-        logger.debug(
-            f"pull request! rank:{rank}, replayable_pull {the_pull}, "
-            f"resistance:{resistance}"
-        )
-        draw_again = True
-        rank_draw = 0
-        rs = {
+    def _hit_miss_sums(self, rank: int, sums: bool) -> list:
+        """Return the (hit, miss, sum) of every token, and flipped, at a rank"""
+        key = (sums, rank)
+        if key not in self.pool["hit_miss_sums"]:
+            self.pool["hit_miss_sums"][key] = [
+                (
+                    self._getHitMissSum(rank, token.hit, token.sum, sums),
+                    self._getHitMissSum(
+                        rank, token.flipped_hit, token.flipped_sum, sums
+                    ),
+                )
+                for token in self.pool["tokens"]
+            ]
+        return self.pool["hit_miss_sums"][key]
+
+    def _pull(
+        self,
+        rank: int,
+        the_pull: list,
+        resistance: bool,
+        rules: PullRules,
+        stop: int | None = None,
+        orders: bool = False,
+        counted: bool = True,
+    ) -> PullResult:
+        """Evaluate a replayable pull via token ids for a given rank
+
+        Only the first stop tokens of the pull are drawn, all of them if stop
+        isn't given. The pull itself is left unchanged. The pull orders are
+        only recorded in the results if orders is set. Pulls that aren't
+        counted are left out of the stats.
+        """
+        trace = _pull_logger.isEnabledFor(logging.DEBUG)
+        if trace:
+            _pull_logger.debug(
+                f"pull request! rank:{rank}, replayable_pull {the_pull}, "
+                f"resistance:{resistance}"
+            )
+        stats = self.stats if counted else None
+        if stats is not None:
+            started = time.perf_counter()
+        if stop is None or stop > len(the_pull):
+            stop = len(the_pull)
+        state = self._pull_state(rank, resistance, rules, orders, counted)
+        draw = 0
+        while state["draw_again"] and draw < stop:
+            self._pull_token(state, the_pull[draw])
+            draw += 1
+
+        rs = self._pull_results(state)
+        if stats is not None:
+            stats.evaluations += 1
+            stats.evaluation_seconds += time.perf_counter() - started
+        return rs
+
+    def _pull_draws(
+        self,
+        rank: int,
+        the_pull: list,
+        resistance: bool,
+        draws: int,
+        rules: PullRules,
+        orders: bool = False,
+    ) -> list:
+        """Evaluate a replayable pull once for every draw cap from 1 to draws
+
+        Walks the pull a single time, taking the results after each draw, so
+        results[i] matches _pull(rank, the_pull, resistance, rules, i + 1).
+        """
+        trace = _pull_logger.isEnabledFor(logging.DEBUG)
+        if trace:
+            _pull_logger.debug(
+                f"pull request! rank:{rank}, replayable_pull {the_pull}, "
+                f"resistance:{resistance}, draws:{draws}"
+            )
+        stats = self.stats
+        if stats is not None:
+            started = time.perf_counter()
+        state = self._pull_state(rank, resistance, rules, orders)
+        results = []
+        for draw in range(draws):
+            if state["draw_again"] and draw < len(the_pull):
+                self._pull_token(state, the_pull[draw])
+            results.append(self._pull_results(state).copy())
+        if stats is not None:
+            stats.evaluations += 1
+            stats.evaluation_seconds += time.perf_counter() - started
+        return results
+
+    def _pull_state(
+        self,
+        rank: int,
+        resistance: bool,
+        rules: PullRules,
+        orders: bool = False,
+        counted: bool = True,
+    ) -> dict:
+        """Start the evaluation state of a pull for a given rank
+
+        The tokens of a pull that isn't counted are left out of the stats.
+        """
+        return {
             "rank": rank,
-            "can-crit": "-",
-            "hits": 0,
-            "misses": 0,
-            "sum": 0,
-            "fortune-hits": 0,
-            "fortune-misses": 0,
-            "fortune-sum": 0,
-            "crit": False,
-            "full": False,
-            "partial": False,
-            "failure": False,
-            "fortune-crit": False,
-            "fortune-full": False,
-            "fortune-partial": False,
-            "fortune-failure": False,
-            "pull-order": [],
-            "fortune-pull-order": [],
-            "costs": {
-                "lost": 0,
-                "taken": 0,
-                "mitigated": 0,
-            },
+            "rules": rules,
+            "stats": self.stats if counted else None,
+            "resistance": resistance,
+            "trace": _pull_logger.isEnabledFor(logging.DEBUG),
+            "hit_miss_sums": self._hit_miss_sums(rank, rules.sums),
+            "rs": PullResult(rank, orders),
+            "draw_again": True,
+            "rank_draw": 0,
+            "canBeStolen": [],
+            "canBeStolenFlipped": [],
+            "baseDrawEnded": False,
+            "latchedFlipped": False,
+            "latched": False,
+            "finalHitMiss": rules.sums,
+            "finalFlippedHitMiss": rules.sums,
+            "finalSum": not rules.sums,
+            "finalFlippedSum": not rules.sums,
+            "canCrit": False,
         }
-        canBeStolen = []
-        canBeStolenFlipped = []
-        baseDrawEnded = False
-        latchedFlipped = False
-        latched = False
-        finalHitMiss = self.sums
-        finalFlippedHitMiss = self.sums
-        finalSum = not self.sums
-        finalFlippedSum = not self.sums
-        canCrit = False
 
-        bHit = 0
-        bMiss = 0
-        bSum = 0
-        fHit = 0
-        fMiss = 0
-        fSum = 0
+    def _copy_pull_state(self, state: dict) -> dict:
+        """Copy a pull state so it can be continued with different tokens"""
+        copied = dict(state)
+        copied["rs"] = state["rs"].copy()
+        copied["canBeStolen"] = list(state["canBeStolen"])
+        copied["canBeStolenFlipped"] = list(state["canBeStolenFlipped"])
+        return copied
+
+    def _pull_token(self, state: dict, p: int) -> None:
+        """Evaluate the next token of a pull, updating the pull state"""
+        trace = state["trace"]
+        rules = state["rules"]
+        rank = state["rank"]
+        hit_miss_sums = state["hit_miss_sums"]
+        rs = state["rs"]
+        canBeStolen = state["canBeStolen"]
+        canBeStolenFlipped = state["canBeStolenFlipped"]
+        baseDrawEnded = state["baseDrawEnded"]
+        latchedFlipped = state["latchedFlipped"]
+        latched = state["latched"]
+        finalHitMiss = state["finalHitMiss"]
+        finalFlippedHitMiss = state["finalFlippedHitMiss"]
+        finalSum = state["finalSum"]
+        finalFlippedSum = state["finalFlippedSum"]
+        canCrit = state["canCrit"]
+        draw_again = True
 
-        while draw_again:
-            if len(the_pull) == 0:
-                break
-            # Get the token definition
-            p = the_pull.pop(0)
-            token = self.pool["tokens"][p]
-            rs["fortune-pull-order"].append(p)
+        stats = state["stats"]
+        if stats is not None:
+            stats.tokens += 1
+
+        # Get the token definition
+        token = self.pool["tokens"][p]
+        if rs.pull_order is not None:
+            rs.fortune_pull_order.append(token.name)
             if not baseDrawEnded:
-                rs["pull-order"].append(p)
-            if "Min Rank" not in token:
-                token["Min Rank"] = 0
-            logger.debug(
-                f"On draw {rank_draw} we drew a {p}. Base ended: {baseDrawEnded}"
+                rs.pull_order.append(token.name)
+        if trace:
+            _pull_logger.debug(
+                f"On draw {state['rank_draw']} we drew a {token.name}. "
+                f"Base ended: {baseDrawEnded}"
             )
-            rank_draw += 1
-
-            fortuneLost = token["Ends Draws"] and resistance
-            if fortuneLost:
-                rs["costs"]["lost"] += 1
-
-            # Check rank compliance
-            minRank = token["Min Rank"]
-            hasRank = minRank <= rank
-            # Default the flipped rank to an impossible rank
-            minFlippedRank = self.max_rank + 1
-            if token["Can Flip"]:
-                # But make the min flipped rank valid if it can flip
-                minFlippedRank = token["Flipped"]["Min Rank"]
-            hasFlippedRank = minFlippedRank <= rank
-
-            logger.debug(
+        state["rank_draw"] += 1
+
+        fortuneLost = token.ends_draws and state["resistance"]
+        if fortuneLost:
+            rs.lost += 1
+
+        # Check rank compliance
+        minRank = token.min_rank
+        hasRank = minRank <= rank
+        # Default the flipped rank to an impossible rank
+        minFlippedRank = rules.max_rank + 1
+        if token.can_flip:
+            # But make the min flipped rank valid if it can flip
+            minFlippedRank = token.flipped_min_rank
+        hasFlippedRank = minFlippedRank <= rank
+
+        if trace:
+            _pull_logger.debug(
                 f"minRank {minRank}, hasRank {hasRank}, "
                 f"minFlippedRank {minFlippedRank}, hasFlippedRank {hasFlippedRank}"
             )
 
-            if not hasRank and not hasFlippedRank:
-                continue
+        if not hasRank and not hasFlippedRank:
+            return
 
-            if token["Enable Crit"] >= 0 and rank >= token["Enable Crit"]:
-                rs["can-crit"] = "Y"
-                canCrit = True
-
-            bHit = 0
-            bMiss = 0
-            bSum = 0
-            fHit = 0
-            fMiss = 0
-            fSum = 0
-            hitVal = 0
-            sumVal = 0
-
-            # Handle Hits/Misses
-            if hasRank:
-                if "Hit Value" in token:
-                    hitVal = token["Hit Value"]
-                if "Sum Value" in token:
-                    sumVal = token["Sum Value"]
-                (bHit, bMiss, bSum) = self._getHitMissSum(rank, minRank, hitVal, sumVal)
-                if not baseDrawEnded and not finalHitMiss:
-                    rs["hits"] += bHit
-                    rs["misses"] += bMiss
-                    if not fortuneLost:
-                        rs["costs"]["mitigated"] += 1 if bHit > 0 else 0
-                        rs["costs"]["taken"] += 1 if bMiss > 0 else 0
-                if not baseDrawEnded and not finalSum:
-                    rs["sum"] += bSum
-            logger.debug(
+        if token.enable_crit >= 0 and rank >= token.enable_crit:
+            rs.can_crit = True
+            canCrit = True
+
+        bHit = 0
+        bMiss = 0
+        bSum = 0
+        fHit = 0
+        fMiss = 0
+        fSum = 0
+
+        # Handle Hits/Misses
+        if hasRank:
+            (bHit, bMiss, bSum) = hit_miss_sums[p][0]
+            if not baseDrawEnded and not finalHitMiss:
+                rs.hits += bHit
+                rs.misses += bMiss
+                if not fortuneLost:
+                    rs.mitigated += 1 if bHit > 0 else 0
+                    rs.taken += 1 if bMiss > 0 else 0
+            if not baseDrawEnded and not finalSum:
+                rs.sum += bSum
+        if trace:
+            _pull_logger.debug(
                 f"canCrit:{canCrit} bHit:{bHit} bMiss:{bMiss} bSum:{bSum} "
-                f"fortune costs: lost:{rs['costs']['lost']} "
-                f"taken:{rs['costs']['taken']} "
-                f"mitigated:{rs['costs']['mitigated']}"
+                f"fortune costs: lost:{rs.lost} "
+                f"taken:{rs.taken} "
+                f"mitigated:{rs.mitigated}"
             )
 
-            # Handle Flipped Hits/Misses/Sums
-            if token["Can Flip"] and hasFlippedRank:
-                if "Hit Value" in token["Flipped"]:
-                    hitVal = token["Flipped"]["Hit Value"]
-                if "Sum Value" in token["Flipped"]:
-                    sumVal = token["Flipped"]["Sum Value"]
-                (fHit, fMiss, fSum) = self._getHitMissSum(
-                    rank, minFlippedRank, hitVal, sumVal
-                )
-                if not finalFlippedHitMiss:
-                    rs["fortune-hits"] += fHit
-                    rs["fortune-misses"] += fMiss
-                if not finalFlippedSum:
-                    rs["fortune-sum"] += fSum
-            else:
-                if not finalFlippedHitMiss:
-                    rs["fortune-hits"] += bHit
-                    rs["fortune-misses"] += bMiss
-                if not finalFlippedSum:
-                    rs["fortune-sum"] += bSum
-            logger.debug(
+        # Handle Flipped Hits/Misses/Sums
+        if token.can_flip and hasFlippedRank:
+            (fHit, fMiss, fSum) = hit_miss_sums[p][1]
+            if not finalFlippedHitMiss:
+                rs.fortune_hits += fHit
+                rs.fortune_misses += fMiss
+            if not finalFlippedSum:
+                rs.fortune_sum += fSum
+        else:
+            if not finalFlippedHitMiss:
+                rs.fortune_hits += bHit
+                rs.fortune_misses += bMiss
+            if not finalFlippedSum:
+                rs.fortune_sum += bSum
+        if trace:
+            _pull_logger.debug(
                 f"fortune hit/miss/sum "
-                f"Hit:{rs['fortune-hits']} "
-                f"Miss:{rs['fortune-misses']} "
-                f"Sum:{rs['fortune-sum']}"
+                f"Hit:{rs.fortune_hits} "
+                f"Miss:{rs.fortune_misses} "
+                f"Sum:{rs.fortune_sum}"
             )
 
-            # Handle Stealing
-            if token["Can Steal"] and hasRank:
-                # Loop over all the prior pulls and see if they can be stolen
-
-                for r in canBeStolen:
-                    rToken = self.pool["tokens"][r]
-                    rHasFlippedRank = bool(
-                        rToken["Can Flip"] and rToken["Flipped"]["Min Rank"] <= rank
-                    )
-
-                    if rToken["Can Be Stolen"] and not baseDrawEnded:
-                        if "Hit Value" in rToken:
-                            hitVal = rToken["Hit Value"]
-                        if "Sum Value" in rToken:
-                            sumVal = rToken["Sum Value"]
-                        (bHit, bMiss, bSum) = self._getHitMissSum(
-                            rank,
-                            rToken["Min Rank"],
-                            hitVal,
-                            sumVal,
-                        )
-                        if rToken["Can Latch"] and latched:
-                            latched = False
-                        if not finalHitMiss:
-                            rs["hits"] -= bHit
-                            rs["misses"] -= bMiss
-                        if not finalSum:
-                            rs["sum"] -= bSum
-                        canBeStolen.remove(r)
-                        break
-
-                for r in canBeStolenFlipped:
-                    rToken = self.pool["tokens"][r]
-                    rHasFlippedRank = (
-                        False
-                        if not rToken["Can Flip"]
-                        else (rToken["Flipped"]["Min Rank"] <= rank)
-                    )
-                    if (rHasFlippedRank and rToken["Flipped"]["Can Latch"]) or (
-                        rToken["Can Latch"] and not rHasFlippedRank
-                    ):
-                        latchedFlipped = False
-
-                    if rHasFlippedRank:
-                        if "Hit Value" in rToken["Flipped"]:
-                            hitVal = rToken["Flipped"]["Hit Value"]
-                        if "Sum Value" in rToken["Flipped"]:
-                            sumVal = rToken["Flipped"]["Sum Value"]
-                        (fHit, fMiss, fSum) = self._getHitMissSum(
-                            rank,
-                            rToken["Flipped"]["Min Rank"],
-                            hitVal,
-                            sumVal,
-                        )
-                    else:
-                        if "Hit Value" in rToken:
-                            hitVal = rToken["Hit Value"]
-                        if "Sum Value" in rToken:
-                            sumVal = rToken["Sum Value"]
-                        (fHit, fMiss, fSum) = self._getHitMissSum(
-                            rank,
-                            rToken["Min Rank"],
-                            hitVal,
-                            sumVal,
-                        )
-                    if not finalFlippedHitMiss:
-                        rs["fortune-hits"] -= fHit
-                        rs["fortune-misses"] -= fMiss
-                    if not finalFlippedSum:
-                        rs["fortune-sum"] -= fSum
-                    canBeStolenFlipped.remove(r)
+        # Handle Stealing
+        if token.can_steal and hasRank:
+            # Loop over all the prior pulls and see if they can be stolen
+
+            for r in canBeStolen:
+                rToken = self.pool["tokens"][r]
+
+                if rToken.can_be_stolen and not baseDrawEnded:
+                    (bHit, bMiss, bSum) = hit_miss_sums[r][0]
+                    if rToken.can_latch and latched:
+                        latched = False
+                    if not finalHitMiss:
+                        rs.hits -= bHit
+                        rs.misses -= bMiss
+                    if not finalSum:
+                        rs.sum -= bSum
+                    canBeStolen.remove(r)
+                    if stats is not None:
+                        stats.steals += 1
                     break
 
-            # Log that we pulled this one, now that we've processed the steals
-            # Process base steals and flipped steals separately
-            if token["Can Be Stolen"]:
-                canBeStolen.insert(0, p)
+            for r in canBeStolenFlipped:
+                rToken = self.pool["tokens"][r]
+                rHasFlippedRank = rToken.can_flip and rToken.flipped_min_rank <= rank
+                if (rHasFlippedRank and rToken.flipped_can_latch) or (
+                    rToken.can_latch and not rHasFlippedRank
+                ):
+                    latchedFlipped = False
 
-            if (token["Can Be Stolen"] and not hasFlippedRank) or (
-                hasFlippedRank and token["Flipped"]["Can Be Stolen"]
-            ):
-                canBeStolenFlipped.insert(0, p)
-
-            if latchedFlipped:
-                # TODO: Figure out a DSL for latching and check it here
-                # Probably need to make sure we check for a previous latch here above
-                # setting the latch
-                latchedFlipped = False
-
-            # Placeholder for Latching
-            if (
-                hasFlippedRank
-                and token["Flipped"]["Can Latch"]
-                or (token["Can Latch"] and not hasFlippedRank)
-            ):
-                latchedFlipped = True
-
-            if latched and not baseDrawEnded:
-                # TODO: Figure out a DSL for latching and check it here
-                # Probably need to make sure we check for a previous latch here above
-                # setting the latch
-                latched = False
-
-            # Placeholder for Latching
-            if token["Can Latch"] and not baseDrawEnded:
-                latched = True
+                if rHasFlippedRank:
+                    (fHit, fMiss, fSum) = hit_miss_sums[r][1]
+                else:
+                    (fHit, fMiss, fSum) = hit_miss_sums[r][0]
+                if not finalFlippedHitMiss:
+                    rs.fortune_hits -= fHit
+                    rs.fortune_misses -= fMiss
+                if not finalFlippedSum:
+                    rs.fortune_sum -= fSum
+                canBeStolenFlipped.remove(r)
+                if stats is not None:
+                    stats.steals += 1
+                break
 
-            # Check if token ends draws
-            if token["Ends Draws"] and not self.ignores_ends_draws:
-                # The replayable pull ends when no more tokens can be drawn for
-                # fortune pulls. If only the base pull is ending here, we still
-                # need to process the fortune pull
-                baseDrawEnded = True
-
-            if (rs["misses"] >= self.miss_ceil or rs["hits"] >= self.hit_ceil) and (
-                (self.hit_ceil_only_on_crit and canCrit)
-                or not self.hit_ceil_only_on_crit
-            ):
-                finalHitMiss = True
-            if rs["sum"] >= self.sum_ceil or rs["sum"] <= self.sum_floor:
-                finalSum = True
-            if finalSum and finalHitMiss:
-                baseDrawEnded = True
-
-            if (
-                rs["fortune-misses"] >= self.miss_ceil
-                or rs["fortune-hits"] >= self.hit_ceil
-            ) and (
-                (self.hit_ceil_only_on_crit and canCrit)
-                or not self.hit_ceil_only_on_crit
-            ):
-                finalFlippedHitMiss = True
-            if (
-                rs["fortune-sum"] >= self.sum_ceil
-                or rs["fortune-sum"] <= self.sum_floor
-            ):
-                finalFlippedSum = True
-            if finalFlippedSum and finalFlippedHitMiss:
-                draw_again = False
-            logger.debug(
+        # Log that we pulled this one, now that we've processed the steals
+        # Process base steals and flipped steals separately
+        if token.can_be_stolen:
+            canBeStolen.insert(0, p)
+
+        if (token.can_be_stolen and not hasFlippedRank) or (
+            hasFlippedRank and token.flipped_can_be_stolen
+        ):
+            canBeStolenFlipped.insert(0, p)
+
+        if latchedFlipped:
+            # TODO: Figure out a DSL for latching and check it here
+            # Probably need to make sure we check for a previous latch here above
+            # setting the latch
+            latchedFlipped = False
+
+        # Placeholder for Latching
+        if (
+            hasFlippedRank
+            and token.flipped_can_latch
+            or (token.can_latch and not hasFlippedRank)
+        ):
+            latchedFlipped = True
+
+        if latched and not baseDrawEnded:
+            # TODO: Figure out a DSL for latching and check it here
+            # Probably need to make sure we check for a previous latch here above
+            # setting the latch
+            latched = False
+
+        # Placeholder for Latching
+        if token.can_latch and not baseDrawEnded:
+            latched = True
+
+        # Check if token ends draws
+        if token.ends_draws and not rules.ignores_ends_draws:
+            # The replayable pull ends when no more tokens can be drawn for
+            # fortune pulls. If only the base pull is ending here, we still
+            # need to process the fortune pull
+            if stats is not None and not baseDrawEnded:
+                stats.ends_draws += 1
+            baseDrawEnded = True
+
+        if (rs.misses >= rules.miss_ceil or rs.hits >= rules.hit_ceil) and (
+            (rules.hit_ceil_only_on_crit and canCrit)
+            or not rules.hit_ceil_only_on_crit
+        ):
+            finalHitMiss = True
+        if rs.sum >= rules.sum_ceil or rs.sum <= rules.sum_floor:
+            finalSum = True
+        if finalSum and finalHitMiss:
+            baseDrawEnded = True
+
+        if (
+            rs.fortune_misses >= rules.miss_ceil
+            or rs.fortune_hits >= rules.hit_ceil
+        ) and (
+            (rules.hit_ceil_only_on_crit and canCrit)
+            or not rules.hit_ceil_only_on_crit
+        ):
+            finalFlippedHitMiss = True
+        if (
+            rs.fortune_sum >= rules.sum_ceil
+            or rs.fortune_sum <= rules.sum_floor
+        ):
+            finalFlippedSum = True
+        if finalFlippedSum and finalFlippedHitMiss:
+            draw_again = False
+            if stats is not None:
+                stats.ceilings += 1
+        if trace:
+            _pull_logger.debug(
                 f"continues: draw_again:{draw_again} base_ended:{baseDrawEnded} "
                 f"finalHitMiss:{finalHitMiss} finalSum:{finalSum} "
                 f"finalFlippedHitMiss:{finalFlippedHitMiss} "
                 f"finalFlippedSum:{finalFlippedSum} "
-                f"ignores_ends_draws:{self.ignores_ends_draws} "
+                f"ignores_ends_draws:{rules.ignores_ends_draws} "
             )
 
-        if self.sums:
-            # Base
-            if rs["sum"] < self.sum_partial:
-                rs["failure"] = True
-            elif canCrit and rs["sum"] >= self.sum_ceil:
-                rs["crit"] = True
-            elif rs["sum"] >= self.sum_full:
-                rs["full"] = True
-            else:
-                rs["partial"] = True
-
-            # Fortune
-            if rs["fortune-sum"] < self.sum_partial:
-                rs["fortune-failure"] = True
-            elif canCrit and rs["fortune-sum"] >= self.sum_ceil:
-                rs["fortune-crit"] = True
-            elif rs["fortune-sum"] >= self.sum_full:
-                rs["fortune-full"] = True
-            else:
-                rs["fortune-partial"] = True
-        else:
-            # Base
-            if rs["misses"] >= self.miss_ceil or rs["hits"] < self.hit_partial:
-                rs["failure"] = True
-            elif canCrit and rs["hits"] >= self.hit_ceil:
-                rs["crit"] = True
-            elif rs["hits"] >= self.hit_full:
-                rs["full"] = True
-            else:
-                rs["partial"] = True
-
-            # Fortune
-            if (
-                rs["fortune-misses"] >= self.miss_ceil
-                or rs["fortune-hits"] < self.hit_partial
-            ):
-                rs["fortune-failure"] = True
-            elif canCrit and rs["fortune-hits"] >= self.hit_ceil:
-                rs["fortune-crit"] = True
-            elif rs["fortune-hits"] >= self.hit_full:
-                rs["fortune-full"] = True
-            else:
-                rs["fortune-partial"] = True
-
-        logger.debug(
-            f"results: fail:{rs['failure']} crit:{rs['crit']} "
-            f"full:{rs['full']} partial:{rs['partial']} "
-            f"fFail:{rs['fortune-failure']} fCrit:{rs['fortune-crit']} "
-            f"fFull:{rs['fortune-full']} fPartial:{rs['fortune-partial']}"
+        state["baseDrawEnded"] = baseDrawEnded
+        state["latchedFlipped"] = latchedFlipped
+        state["latched"] = latched
+        state["finalHitMiss"] = finalHitMiss
+        state["finalFlippedHitMiss"] = finalFlippedHitMiss
+        state["finalSum"] = finalSum
+        state["finalFlippedSum"] = finalFlippedSum
+        state["canCrit"] = canCrit
+        state["draw_again"] = draw_again
+
+    def _pull_results(self, state: dict) -> "PullResult":
+        """Grade the pull state into its final results"""
+        trace = state["trace"]
+        rules = state["rules"]
+        rs = state["rs"]
+        canCrit = state["canCrit"]
+
+        rs.outcome = self._grade(rs.hits, rs.misses, rs.sum, canCrit, rules)
+        rs.fortune_outcome = FORTUNE + self._grade(
+            rs.fortune_hits, rs.fortune_misses, rs.fortune_sum, canCrit, rules
         )
 
+        if trace:
+            _pull_logger.debug(
+                f"results: {OUTCOMES[rs.outcome]} {OUTCOMES[rs.fortune_outcome]}"
+            )
+
         return rs
 
-    def pull(self) -> list:
-        """Evaluate a pull from the bag(s)"""
+    def _grade(
+        self, hits: int, misses: int, total: int, can_crit: bool, rules: PullRules
+    ) -> int:
+        """Grade the totals of a pull into FAILURE, PARTIAL, FULL or CRIT"""
+        if rules.sums:
+            if total < rules.sum_partial:
+                return FAILURE
+            if can_crit and total >= rules.sum_ceil:
+                return CRIT
+            if total >= rules.sum_full:
+                return FULL
+            return PARTIAL
+        if misses >= rules.miss_ceil or hits < rules.hit_partial:
+            return FAILURE
+        if can_crit and hits >= rules.hit_ceil:
+            return CRIT
+        if hits >= rules.hit_full:
+            return FULL
+        return PARTIAL
+
+    def pull(self, rules: PullRules | None = None) -> list:
+        """Evaluate a pull from the bag(s)
+
+        rules defaults to the current pull configuration.
+        """
+        if rules is None:
+            rules = self.pull_rules()
         # Get the replayable pull list.
         # This handles "Return to Bag" abilities
-        the_pull = self._replayable_pull()
+        the_pull = self._replayable_pull(rules=rules)
+
+        keys = _SUM_KEYS if rules.sums else _HIT_MISS_KEYS
+        draws = self._draw_cap(rules)
+        pulls = [{"draws": draw_halt, "ranks": []} for draw_halt in range(1, draws + 1)]
+        for rank in range(rules.max_rank + 1):
+            results = self._pull_draws(
+                rank, the_pull, False, draws, orders=True, rules=rules
+            )
+            for ranks, rs in zip(pulls, results, strict=True):
+                ranks["ranks"].append(rs.to_dict(keys))
 
-        pulls = []
-        for draw_halt in range(1, self.max_draws + 1):
+        return pulls
+
+    def odds_key(self, rules: PullRules | None = None) -> str:
+        """Return a hash of everything that the results of odds() depend on
+
+        Covers the compiled token definitions in each bag, the bag draws, the
+        pull configuration and ODDS_VERSION. The order tokens were listed in doesn't
+        change the odds, so it doesn't change the hash either.
+        """
+        if rules is None:
+            rules = self.pull_rules()
+        tokens = self.pool["tokens"]
+        bags = []
+        for bag in self.pool["bags"]:
+            counts = {}
+            for token_id in bag:
+                counts[token_id] = counts.get(token_id, 0) + 1
+            # Leave out the token ids, which only follow the config's order
+            bags.append(sorted([list(tokens[i][1:]), n] for i, n in counts.items()))
+        key = {
+            "version": ODDS_VERSION,
+            "bags": bags,
+            "bag_draws": [list(draws) for draws in rules.bag_draws],
+            "max_draws": self._draw_cap(rules),
+            "max_rank": rules.max_rank,
+            "ignores_ends_draws": rules.ignores_ends_draws,
+            "sums": rules.sums,
+            "hit_ceil_only_on_crit": rules.hit_ceil_only_on_crit,
+            "hit_ceil": rules.hit_ceil,
+            "hit_full": rules.hit_full,
+            "hit_partial": rules.hit_partial,
+            "miss_ceil": rules.miss_ceil,
+            "sum_ceil": rules.sum_ceil,
+            "sum_full": rules.sum_full,
+            "sum_partial": rules.sum_partial,
+            "sum_floor": rules.sum_floor,
+        }
+        canonical = json.dumps(key, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+    def composition_odds(self, deltas: dict, bag: int = 0) -> dict:
+        """Compute the exact odds for every variation of a bag's token counts
+
+        deltas maps token names to the changes in their count to try, such
+        as {"Gobstopper": [0, 1], "Miss": [-2, -1, 0]}, for every combination
+        of them. The tokens must already be in the compiled token table, if
+        only with a count of 0 in the bag Specification. Variations that
+        would need a negative count are left out. Returns a row per variation
+        with the token counts, deltas and odds().
+        """
+        token_ids = self.pool["token_ids"]
+        unknown = [name for name in deltas if name not in token_ids]
+        if unknown:
+            raise ValueError(f"Tokens not in the token pool: {', '.join(unknown)}")
+        if bag >= len(self.pool["bags"]):
+            raise ValueError(f"Bag {bag} not found in the bag pool")
+
+        counts = {}
+        for token_id in self.pool["bags"][bag]:
+            counts[token_id] = counts.get(token_id, 0) + 1
+        names = list(deltas)
+
+        # Vary the bag in a copy of the pool, leaving this one as it is
+        variation = copy.copy(self)
+        variation.pool = dict(self.pool, bags=list(self.pool["bags"]))
+        rules = self.pull_rules()
+        rows = []
+        for changes in itertools.product(*(deltas[name] for name in names)):
+            varied = dict(counts)
+            for name, delta in zip(names, changes, strict=True):
+                token_id = token_ids[name]
+                varied[token_id] = varied.get(token_id, 0) + delta
+            if any(count < 0 for count in varied.values()):
+                continue
+            variation.pool["bags"][bag] = array(
+                "i", [token_id for token_id, n in varied.items() for _ in range(n)]
+            )
+            rows.append(
+                {
+                    "counts": {name: varied.get(token_ids[name], 0) for name in names},
+                    "deltas": dict(zip(names, changes, strict=True)),
+                    "odds": variation.odds(rules),
+                }
+            )
+
+        return {"bag": bag, "tokens": names, "rows": rows}
+
+    def odds(self, rules: PullRules | None = None) -> list:
+        """Compute exact outcome probabilities for every rank and draw cap
+
+        Reuses the results from odds_cache when one is set and it has them.
+        rules defaults to the current pull configuration.
+        """
+        if rules is None:
+            rules = self.pull_rules()
+        if self.odds_cache is None:
+            return self._odds(rules)
+        key = self.odds_key(rules)
+        odds = self.odds_cache.get(key)
+        if odds is None:
+            odds = self._odds(rules)
+            self.odds_cache.put(key, odds)
+        return odds
+
+    def _odds(self, rules: PullRules) -> list:
+        """Compute exact outcome probabilities for every rank and draw cap
+
+        Walks the tree of ordered draws instead of sampling. Identical tokens
+        are grouped so each branch is weighted by the chance of drawing that
+        token name from what is left in the bag, branches stop as soon as the
+        pull can't draw any further, and branches that reach the same pull
+        state with the same tokens left in the bag(s) are merged.
+        """
+        logger = logging.getLogger("tokenbag.odds")
+
+        outcomes = OUTCOMES
+        odds = []
+        for draw_halt in range(1, self._draw_cap(rules) + 1):
             ranks = {"draws": draw_halt, "ranks": []}
+            for rank in range(rules.max_rank + 1):
+                rs = {"rank": rank}
+                rs.update(dict.fromkeys(outcomes, 0.0))
+                ranks["ranks"].append(rs)
+            odds.append(ranks)
+
+        # Group each bag into the count of each token name it holds
+        bag_pulls = self._bag_sequence(rules)
+        slots = []
+        counts = []
+        for bag in sorted(set(bag_pulls)):
+            ids = {}
+            for token_id in self.pool["bags"][bag]:
+                ids[token_id] = ids.get(token_id, 0) + 1
+            for token_id, count in ids.items():
+                slots.append((bag, token_id))
+                counts.append(count)
+
+        def add(chances: dict, rs: PullResult, chance: float) -> None:
+            chances[outcomes[rs.outcome]] += chance
+            chances[outcomes[rs.fortune_outcome]] += chance
+
+        for rank in range(rules.max_rank + 1):
+            # Chances of pulls that are already over, for every later draw cap
+            finished = dict.fromkeys(outcomes, 0.0)
+            state = self._pull_state(rank, False, rules=rules, counted=False)
+            if not bag_pulls:
+                add(finished, self._pull_results(state), 1.0)
+            frontier = {(): (1.0, tuple(counts), state)}
+
+            for draw, bag in enumerate(bag_pulls):
+                next_frontier = {}
+                for chance, left, state in frontier.values():
+                    total = sum(
+                        left[i] for i, (slot_bag, _) in enumerate(slots)
+                        if slot_bag == bag
+                    )
+                    if total == 0:
+                        # Nothing left to draw, so the pull is over
+                        add(finished, self._pull_results(state), chance)
+                        continue
+
+                    for i, (slot_bag, token_id) in enumerate(slots):
+                        if slot_bag != bag or left[i] == 0:
+                            continue
+                        token = self.pool["tokens"][token_id]
+                        next_chance = chance * left[i] / total
+                        next_left = left
+                        if not token.return_to_bag:
+                            next_left = left[:i] + (left[i] - 1,) + left[i + 1 :]
+
+                        next_state = self._copy_pull_state(state)
+                        self._pull_token(next_state, token_id)
+                        if (
+                            not next_state["draw_again"]
+                            or self._ends_pull(token, rules)
+                            or draw + 1 == len(bag_pulls)
+                        ):
+                            add(finished, self._pull_results(next_state), next_chance)
+                            continue
+
+                        rs = next_state["rs"]
+                        key = (
+                            next_left,
+                            rs.hits,
+                            rs.misses,
+                            rs.sum,
+                            rs.fortune_hits,
+                            rs.fortune_misses,
+                            rs.fortune_sum,
+                            tuple(next_state["canBeStolen"]),
+                            tuple(next_state["canBeStolenFlipped"]),
+                            next_state["baseDrawEnded"],
+                            next_state["latchedFlipped"],
+                            next_state["latched"],
+                            next_state["finalHitMiss"],
+                            next_state["finalFlippedHitMiss"],
+                            next_state["finalSum"],
+                            next_state["finalFlippedSum"],
+                            next_state["canCrit"],
+                        )
+                        if key in next_frontier:
+                            next_chance += next_frontier[key][0]
+                        next_frontier[key] = (next_chance, next_left, next_state)
+                frontier = next_frontier
+
+                chances = odds[draw]["ranks"][rank]
+                for outcome in outcomes:
+                    chances[outcome] += finished[outcome]
+                for chance, _, state in frontier.values():
+                    add(chances, self._pull_results(state), chance)
+
+            # Draw caps past the last draw see the pulls as they finished
+            for ranks in odds[len(bag_pulls) :]:
+                for outcome in outcomes:
+                    ranks["ranks"][rank][outcome] += finished[outcome]
+
+        logger.debug(odds)
+        return odds
+
+    def resistance_odds(self, rules: PullRules | None = None) -> list:
+        """Compute the exact distribution of resistance pull costs
+
+        Walks every ordered draw of a resistance_pull(), grouping identical
+        tokens like odds(), for the joint chances of each (mitigated, taken,
+        lost) cost at every rank and draw cap. Each rank also has the
+        expectation and variance of each cost. rules defaults to the current
+        pull configuration, overridden like resistance_pull().
+        """
+        if rules is None:
+            rules = self.pull_rules()
+        rules = rules._replace(**_RESISTANCE_RULES)
+        draws = self._draw_cap(rules)
+        bag_pulls = self._bag_sequence(rules)
+        costs = [[{} for _ in range(rules.max_rank + 1)] for _ in range(draws)]
+
+        # Group each bag into the count of each token it holds
+        slots = []
+        counts = []
+        for bag in sorted(set(bag_pulls)):
+            ids = {}
+            for token_id in self.pool["bags"][bag]:
+                ids[token_id] = ids.get(token_id, 0) + 1
+            for token_id, count in ids.items():
+                slots.append((bag, token_id))
+                counts.append(count)
+
+        def add(rank: int, draw: int, rs: PullResult, chance: float) -> None:
+            # A finished pull has the same costs for every later draw cap
+            for chances in costs[draw:]:
+                cost = (rs.mitigated, rs.taken, rs.lost)
+                chances[rank][cost] = chances[rank].get(cost, 0.0) + chance
+
+        def walk(rank: int, draw: int, state: dict, left: tuple, chance: float):
+            bag = bag_pulls[draw]
+            total = sum(
+                left[i] for i, (slot_bag, _) in enumerate(slots) if slot_bag == bag
+            )
+            if total == 0:
+                # Nothing left to draw, so the pull is over
+                add(rank, draw, state["rs"], chance)
+                return
+            for i, (slot_bag, token_id) in enumerate(slots):
+                if slot_bag != bag or left[i] == 0:
+                    continue
+                token = self.pool["tokens"][token_id]
+                next_chance = chance * left[i] / total
+                next_left = left
+                if not token.return_to_bag:
+                    next_left = left[:i] + (left[i] - 1,) + left[i + 1 :]
+
+                next_state = self._copy_pull_state(state)
+                self._pull_token(next_state, token_id)
+                if (
+                    not next_state["draw_again"]
+                    or self._ends_pull(token, rules)
+                    or draw + 1 == len(bag_pulls)
+                ):
+                    add(rank, draw, next_state["rs"], next_chance)
+                    continue
+                # The costs so far, for the pulls capped at this draw
+                rs = next_state["rs"]
+                cost = (rs.mitigated, rs.taken, rs.lost)
+                chances = costs[draw][rank]
+                chances[cost] = chances.get(cost, 0.0) + next_chance
+                walk(rank, draw + 1, next_state, next_left, next_chance)
+
+        for rank in range(rules.max_rank + 1):
+            state = self._pull_state(rank, True, rules=rules, counted=False)
+            if bag_pulls:
+                walk(rank, 0, state, tuple(counts), 1.0)
+            else:
+                add(rank, 0, state["rs"], 1.0)
+
+        results = []
+        for draw, ranks in enumerate(costs):
+            results.append({"draws": draw + 1, "ranks": []})
+            for rank, chances in enumerate(ranks):
+                rs = {"rank": rank, "costs": [], "expected": {}, "variance": {}}
+                for (mitigated, taken, lost), chance in sorted(chances.items()):
+                    rs["costs"].append(
+                        {
+                            "mitigated": mitigated,
+                            "taken": taken,
+                            "lost": lost,
+                            "chance": chance,
+                        }
+                    )
+                for name in ("mitigated", "taken", "lost"):
+                    mean = sum(c[name] * c["chance"] for c in rs["costs"])
+                    rs["expected"][name] = mean
+                    rs["variance"][name] = sum(
+                        (c[name] - mean) ** 2 * c["chance"] for c in rs["costs"]
+                    )
+                results[-1]["ranks"].append(rs)
+        return results
 
-            for rank in range(self.max_rank + 1):
-                rs = self._pull(rank, copy.deepcopy(the_pull)[0:draw_halt], False)
+    def simulate(
+        self,
+        n: int,
+        ranks: list | None = None,
+        seed=None,
+        rules: PullRules | None = None,
+    ) -> dict:
+        """Count the outcomes of n pulls for every rank and draw cap
+
+        Returns the outcome counts as counts[draw cap - 1][rank][outcome],
+        with the ranks in the order requested and the outcomes in the order
+        of OUTCOMES. Uses numpy to evaluate the pulls as a batch when it is
+        installed, falling back to evaluating them one by one for bags with
+        tokens that return to the bag and for pulls with tokens that steal.
+        rules defaults to the current pull configuration.
+
+        The pulls are shuffled from a single generator seeded with seed, not
+        from the per-pull streams of set_rng, so the pulls of a batch can't
+        be regenerated one at a time with jump() or spawn().
+        """
+        logger = logging.getLogger("tokenbag.simulate")
+        if rules is None:
+            rules = self.pull_rules()
+        if ranks is None:
+            ranks = list(range(rules.max_rank + 1))
+        draws = self._draw_cap(rules)
+        results = {
+            "pulls": n,
+            "draws": list(range(1, draws + 1)),
+            "ranks": list(ranks),
+            "outcomes": list(OUTCOMES),
+            "counts": [[[0] * len(OUTCOMES) for _ in ranks] for _ in range(draws)],
+        }
 
-                if self.sums:
-                    del rs["hits"]
-                    del rs["misses"]
-                    del rs["fortune-hits"]
-                    del rs["fortune-misses"]
-                else:
-                    del rs["sum"]
-                    del rs["fortune-sum"]
-                ranks["ranks"].append(copy.deepcopy(rs))
-            pulls.append(copy.deepcopy(ranks))
+        bag_pulls = self._bag_sequence(rules)
+        returns = any(
+            self.pool["tokens"][token_id].return_to_bag
+            for bag in set(bag_pulls)
+            for token_id in self.pool["bags"][bag]
+        )
+        if np is None or returns:
+            logger.debug("Simulating %d pulls one at a time", n)
+            rng = random.Random(seed)
+            for _ in range(n):
+                the_pull = self._replayable_pull(rules, rng)
+                self._tally(results["counts"], the_pull, ranks, rules)
+            return results
 
-        return pulls
+        rng = np.random.default_rng(seed)
+        counts = np.zeros((draws, len(ranks), len(OUTCOMES)), np.int64)
+        chunk = 1 << 16
+        for start in range(0, n, chunk):
+            the_pulls, lengths = self._shuffled_pulls(
+                rng, bag_pulls, min(chunk, n - start), rules
+            )
+            skipped = self._tally_batch(
+                [(counts, rules)], the_pulls, lengths, ranks, rules
+            )
+            for row in np.flatnonzero(skipped):
+                the_pull = the_pulls[row, : lengths[row]].tolist()
+                self._tally(results["counts"], the_pull, ranks, rules)
+        logger.debug("Simulated %d pulls as a batch", n)
 
-    def pull_one(self, rank: int, type: PullType) -> list:
-        """Evaluate a pull from the bag(s)"""
-        # Get the replayable pull list.
-        # This handles "Return to Bag" abilities
-        logger = logging.getLogger("tokenbag.pull_one")
-        logger.debug(vars(self))
+        results["counts"] = (counts + np.array(results["counts"])).tolist()
+        return results
 
-        do_resistance = True
-        miss_ceil = copy.deepcopy(self.miss_ceil)
-        hit_ceil = copy.deepcopy(self.hit_ceil)
-        ignores_end = copy.deepcopy(self.ignores_ends_draws)
-        max_draws = copy.deepcopy(self.max_draws)
-        sums = copy.deepcopy(self.sums)
+    def sweep(
+        self, grid: dict, n: int, ranks: list | None = None, seed=None
+    ) -> dict:
+        """Count the outcome rates of n pulls for every combination of settings
+
+        grid maps configure_pull parameters in SWEEP_PARAMETERS to the values
+        to try. The same n pulls are evaluated for every combination, so the
+        rates differ only by the settings. Each distinct pull is evaluated once
+        for every combination of the settings that change when a pull stops,
+        and graded from that for the settings that only change its grading.
+        Every draw cap comes from the same evaluation. Returns a row per
+        combination with its parameters and rates[rank][outcome], in the order
+        of ranks and OUTCOMES.
+        """
+        unknown = [name for name in grid if name not in SWEEP_PARAMETERS]
+        if unknown:
+            raise ValueError(f"Can't sweep over {', '.join(unknown)}")
+        caps = list(grid.get("max_draws", [self.max_draws]))
+        names = [name for name in grid if name != "max_draws"]
+        # Draw the pulls once at the largest draw cap, 0 being unlimited
+        rules = self.pull_rules(max_draws=0 if 0 in caps else max(caps))
+        if ranks is None:
+            ranks = list(range(rules.max_rank + 1))
+        draws = self._draw_cap(rules)
+        the_pulls, lengths, weights = self._sweep_pulls(n, seed, rules)
+
+        combinations = [
+            dict(zip(names, values, strict=True))
+            for values in itertools.product(*(grid[name] for name in names))
+        ]
+        # Combinations that only grade the pulls differently share their pulls'
+        # evaluation, so it is only done once for each set of stopping rules
+        groups = {}
+        for index, parameters in enumerate(combinations):
+            varied = rules._replace(**parameters)
+            groups.setdefault(_stopping_rules(varied), []).append((index, varied))
+
+        tallied = [None] * len(combinations)
+        for group in groups.values():
+            evaluated = group[0][1]
+            tallies = [
+                ([[[0] * len(OUTCOMES) for _ in ranks] for _ in range(draws)], varied)
+                for _, varied in group
+            ]
+            skipped = range(len(weights))
+            if lengths is not None:
+                batches = [
+                    (np.zeros((draws, len(ranks), len(OUTCOMES)), np.int64), varied)
+                    for _, varied in group
+                ]
+                skipped = np.flatnonzero(
+                    self._tally_batch(
+                        batches, the_pulls, lengths, ranks, evaluated, weights
+                    )
+                )
+            for row in skipped:
+                the_pull = the_pulls[row]
+                if lengths is not None:
+                    the_pull = the_pull[: lengths[row]].tolist()
+                self._tally_grades(
+                    tallies, the_pull, ranks, evaluated, int(weights[row])
+                )
+            for k, (index, _) in enumerate(group):
+                counts = tallies[k][0]
+                if lengths is not None:
+                    counts = (batches[k][0] + np.array(counts)).tolist()
+                tallied[index] = counts
+
+        rows = []
+        for parameters, counts in zip(combinations, tallied, strict=True):
+            for cap in caps:
+                draw = min(cap, draws) if cap > 0 else draws
+                rows.append(
+                    {
+                        "parameters": {**parameters, "max_draws": cap},
+                        "rates": [
+                            [count / n for count in outcomes]
+                            for outcomes in counts[draw - 1]
+                        ],
+                    }
+                )
 
-        do_resistance = False
+        return {
+            "pulls": n,
+            "distinct-pulls": len(weights),
+            "ranks": list(ranks),
+            "outcomes": list(OUTCOMES),
+            "rows": rows,
+        }
+
+    def _sweep_pulls(self, n: int, seed, rules: PullRules) -> tuple:
+        """Return the distinct pulls of n pulls, their lengths and their counts
+
+        Uses a numpy batch of pulls like simulate() when it can, otherwise
+        the lengths are None and the pulls are lists of token ids.
+        """
+        bag_pulls = self._bag_sequence(rules)
+        returns = any(
+            self.pool["tokens"][token_id].return_to_bag
+            for bag in set(bag_pulls)
+            for token_id in self.pool["bags"][bag]
+        )
+        if np is None or returns:
+            rng = random.Random(seed)
+            pulls = {}
+            for _ in range(n):
+                the_pull = tuple(self._replayable_pull(rules, rng))
+                pulls[the_pull] = pulls.get(the_pull, 0) + 1
+            return (list(pulls), None, list(pulls.values()))
+
+        the_pulls, lengths = self._shuffled_pulls(
+            np.random.default_rng(seed), bag_pulls, n, rules
+        )
+        # Tokens past the end of a pull aren't drawn, so don't tell pulls apart
+        the_pulls[np.arange(the_pulls.shape[1]) >= lengths[:, None]] = 0
+        rows, weights = np.unique(
+            np.column_stack((lengths, the_pulls)), axis=0, return_counts=True
+        )
+        return (rows[:, 1:], rows[:, 0], weights)
+
+    def simulate_parallel(
+        self, n: int, jobs: int = 0, ranks: list | None = None, seed=None
+    ) -> dict:
+        """Count the outcomes of n pulls split across worker processes
+
+        Each worker simulates its share of the pulls on its own copy of this
+        TokenBag, seeded independently from the one master seed, and sends
+        back only its outcome counts to be merged. jobs defaults to the
+        number of CPUs. Like simulate(), the pulls can't be regenerated one
+        at a time.
+        """
+        if jobs <= 0:
+            jobs = os.cpu_count() or 1
+        results = self.simulate(0, ranks)
+        results["pulls"] = n
+
+        master = random.Random(seed)
+        seeds = [master.getrandbits(128) for _ in range(jobs)]
+        shares = [n // jobs + (1 if job < n % jobs else 0) for job in range(jobs)]
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = [
+                executor.submit(_simulate, self, share, results["ranks"], job_seed)
+                for share, job_seed in zip(shares, seeds, strict=True)
+                if share
+            ]
+            for future in futures:
+                (job_counts, stats) = future.result()
+                if stats is not None:
+                    self.stats.merge(stats)
+                for totals, counts in zip(results["counts"], job_counts, strict=True):
+                    for total, count in zip(totals, counts, strict=True):
+                        for outcome in range(len(OUTCOMES)):
+                            total[outcome] += count[outcome]
+        return results
+
+    def _tally(
+        self,
+        counts: list,
+        the_pull: list,
+        ranks: list,
+        rules: PullRules,
+        weight: int = 1,
+    ) -> None:
+        """Count the outcomes of a replayable pull for every draw cap
+
+        weight is the number of times the pull was drawn.
+        """
+        for i, rank in enumerate(ranks):
+            results = self._pull_draws(
+                rank, the_pull, False, len(counts), rules=rules
+            )
+            for draw, rs in enumerate(results):
+                counts[draw][i][rs.outcome] += weight
+                counts[draw][i][rs.fortune_outcome] += weight
+
+    def _tally_grades(
+        self,
+        tallies: list,
+        the_pull: list,
+        ranks: list,
+        rules: PullRules,
+        weight: int = 1,
+    ) -> None:
+        """Count the outcomes of a replayable pull under several gradings
+
+        Like _tally, but tallies pairs the outcome counts with the rules to
+        grade them by, as for _tally_batch, so the pull is only evaluated once
+        for all of them.
+        """
+        stats = self.stats
+        for i, rank in enumerate(ranks):
+            if stats is not None:
+                started = time.perf_counter()
+            state = self._pull_state(rank, False, rules)
+            for draw in range(len(tallies[0][0])):
+                if state["draw_again"] and draw < len(the_pull):
+                    self._pull_token(state, the_pull[draw])
+                rs = state["rs"]
+                can_crit = state["canCrit"]
+                for counts, grading in tallies:
+                    outcome = self._grade(
+                        rs.hits, rs.misses, rs.sum, can_crit, grading
+                    )
+                    counts[draw][i][outcome] += weight
+                    outcome = FORTUNE + self._grade(
+                        rs.fortune_hits,
+                        rs.fortune_misses,
+                        rs.fortune_sum,
+                        can_crit,
+                        grading,
+                    )
+                    counts[draw][i][outcome] += weight
+            if stats is not None:
+                stats.evaluations += 1
+                stats.evaluation_seconds += time.perf_counter() - started
+
+    def _shuffled_pulls(
+        self, rng, bag_pulls: list, n: int, rules: PullRules
+    ) -> tuple:
+        """Return n replayable pulls of token ids, and the length of each"""
+        the_pulls = np.zeros((n, len(bag_pulls)), np.intp)
+        lengths = np.full(n, len(bag_pulls))
+        for bag in set(bag_pulls):
+            # Draw the first tokens of a shuffle of the bag for every pull
+            tokens = np.asarray(self.pool["bags"][bag], np.intp)
+            columns = [i for i, b in enumerate(bag_pulls) if b == bag]
+            if len(columns) > len(tokens):
+                # Pulls run out of tokens when the bag is empty
+                lengths = np.minimum(lengths, columns[len(tokens)])
+                columns = columns[: len(tokens)]
+            the_pulls[:, columns] = tokens[
+                self._sample_positions(rng, len(tokens), len(columns), n)
+            ]
+
+        # The replayable pull stops after a token that ends draws
+        ends = np.array([self._ends_pull(t, rules) for t in self.pool["tokens"]])
+        ended = ends[the_pulls]
+        lengths = np.where(
+            ended.any(axis=1), np.minimum(lengths, ended.argmax(axis=1) + 1), lengths
+        )
+        return (the_pulls, lengths)
+
+    def _sample_positions(self, rng, size: int, k: int, n: int):
+        """Return n rows of k distinct positions from 0 to size, in draw order
+
+        Draws each position from the ones left in its row, so only the k drawn
+        positions are generated rather than a shuffle of the whole bag.
+        """
+        picks = np.zeros((n, k), np.intp)
+        for i in range(k):
+            # Pick among the size - i positions left, then step over the taken
+            # ones in order so it lands on the position it picked
+            pick = rng.integers(0, size - i, n)
+            for taken in np.sort(picks[:, :i], axis=1).T:
+                pick += pick >= taken
+            picks[:, i] = pick
+        return picks
+
+    def _tally_batch(
+        self,
+        tallies: list,
+        the_pulls,
+        lengths,
+        ranks: list,
+        rules: PullRules,
+        weights=None,
+    ):
+        """Count the outcomes of a batch of replayable pulls with numpy
+
+        Evaluates the pulls a draw at a time across the whole batch, the same
+        way _pull does for a single pull. tallies pairs the outcome counts,
+        counts[draw cap - 1][rank][outcome], with the rules to grade them by,
+        which may only differ from rules in how the pulls are graded, see
+        _stopping_rules. Pulls with tokens that steal need the order of the
+        earlier tokens, so they are skipped and returned as a mask for the
+        caller to evaluate. weights optionally gives the number of times each
+        pull was drawn.
+        """
+        tokens = self.pool["tokens"]
+        n = the_pulls.shape[0]
+        steals = np.array([t.can_steal for t in tokens])
+        drawn = np.arange(the_pulls.shape[1]) < lengths[:, None]
+        skipped = (steals[the_pulls] & drawn).any(axis=1)
+
+        can_flip = np.array([t.can_flip for t in tokens])
+        min_rank = np.array([t.min_rank for t in tokens])
+        min_flipped_rank = np.array(
+            [t.flipped_min_rank if t.can_flip else rules.max_rank + 1 for t in tokens]
+        )
+        enable_crit = np.array([t.enable_crit for t in tokens])
+        ends_draws = np.array([t.ends_draws for t in tokens])
+
+        for i, rank in enumerate(ranks):
+            has_rank = min_rank <= rank
+            has_flipped_rank = min_flipped_rank <= rank
+            crit_enabled = (enable_crit >= 0) & (rank >= enable_crit)
+            hit_miss_sums = self._hit_miss_sums(rank, rules.sums)
+            base = np.array([values[0] for values in hit_miss_sums])
+            flipped = np.array([values[1] for values in hit_miss_sums])
+            # Tokens without the rank add nothing to the base pull, and only
+            # flip for the fortune pull when they have the flipped rank
+            base = np.where(has_rank[:, None], base, 0)
+            fortune = np.where((can_flip & has_flipped_rank)[:, None], flipped, base)
+
+            hits = np.zeros(n, np.int64)
+            misses = np.zeros(n, np.int64)
+            sums = np.zeros(n, np.int64)
+            fortune_hits = np.zeros(n, np.int64)
+            fortune_misses = np.zeros(n, np.int64)
+            fortune_sums = np.zeros(n, np.int64)
+            can_crit = np.zeros(n, bool)
+            base_ended = np.zeros(n, bool)
+            final_hit_miss = np.full(n, rules.sums)
+            final_sum = np.full(n, not rules.sums)
+            final_flipped_hit_miss = np.full(n, rules.sums)
+            final_flipped_sum = np.full(n, not rules.sums)
+            draw_again = ~skipped
+            pull_weights = np.where(skipped, 0, 1 if weights is None else weights)
+
+            for draw in range(tallies[0][0].shape[0]):
+                if draw < the_pulls.shape[1]:
+                    p = the_pulls[:, draw]
+                    # Tokens without any rank are drawn but otherwise ignored
+                    live = draw_again & (draw < lengths)
+                    live &= has_rank[p] | has_flipped_rank[p]
+                    can_crit |= live & crit_enabled[p]
+
+                    add = live & ~base_ended & ~final_hit_miss
+                    hits += np.where(add, base[p, 0], 0)
+                    misses += np.where(add, base[p, 1], 0)
+                    sums += np.where(live & ~base_ended & ~final_sum, base[p, 2], 0)
+
+                    add = live & ~final_flipped_hit_miss
+                    fortune_hits += np.where(add, fortune[p, 0], 0)
+                    fortune_misses += np.where(add, fortune[p, 1], 0)
+                    add = live & ~final_flipped_sum
+                    fortune_sums += np.where(add, fortune[p, 2], 0)
+
+                    if not rules.ignores_ends_draws:
+                        base_ended |= live & ends_draws[p]
+
+                    ceiling = (misses >= rules.miss_ceil) | (hits >= rules.hit_ceil)
+                    flipped_ceiling = (fortune_misses >= rules.miss_ceil) | (
+                        fortune_hits >= rules.hit_ceil
+                    )
+                    if rules.hit_ceil_only_on_crit:
+                        ceiling &= can_crit
+                        flipped_ceiling &= can_crit
+                    final_hit_miss |= live & ceiling
+                    final_sum |= live & (
+                        (sums >= rules.sum_ceil) | (sums <= rules.sum_floor)
+                    )
+                    base_ended |= live & final_sum & final_hit_miss
+                    final_flipped_hit_miss |= live & flipped_ceiling
+                    final_flipped_sum |= live & (
+                        (fortune_sums >= rules.sum_ceil)
+                        | (fortune_sums <= rules.sum_floor)
+                    )
+                    draw_again &= ~(live & final_flipped_sum & final_flipped_hit_miss)
+
+                for offset, totals in (
+                    (0, (hits, misses, sums, can_crit, pull_weights)),
+                    (
+                        FORTUNE,
+                        (
+                            fortune_hits,
+                            fortune_misses,
+                            fortune_sums,
+                            can_crit,
+                            pull_weights,
+                        ),
+                    ),
+                ):
+                    if len(tallies) > 1:
+                        # There are far fewer distinct totals than pulls to grade
+                        totals = self._distinct_totals(*totals)
+                    for counts, grading in tallies:
+                        for outcome, result in enumerate(
+                            self._grade_batch(*totals[:4], grading)
+                        ):
+                            counts[draw, i, offset + outcome] += totals[4][result].sum()
+
+        return skipped
+
+    def _distinct_totals(self, hits, misses, sums, can_crit, weights) -> tuple:
+        """Return the distinct totals of a batch of pulls and their weights
+
+        Totals only found in pulls without any weight may be left out.
+        """
+        if not len(hits):
+            return (hits, misses, sums, can_crit, weights)
+        columns = (hits, misses, sums, can_crit.astype(np.int64))
+        # Number each combination of totals, as the totals only span a few values
+        key = np.zeros(len(hits), np.int64)
+        spans = []
+        for column in columns:
+            low = int(column.min())
+            span = int(column.max()) - low + 1
+            key = key * span + (column - low)
+            spans.append((low, span))
+        if math.prod(span for _, span in spans) <= 1 << 20:
+            weighted = np.bincount(key, weights=weights)
+            present = np.flatnonzero(weighted)
+            weighted = weighted[present]
+        else:
+            (present, inverse) = np.unique(key, return_inverse=True)
+            weighted = np.bincount(inverse, weights=weights)
+        totals = []
+        rest = present
+        for low, span in reversed(spans):
+            totals.append(rest % span + low)
+            rest = rest // span
+        (hits, misses, sums, can_crit) = reversed(totals)
+        return (hits, misses, sums, can_crit.astype(bool), weighted.astype(np.int64))
+
+    def _grade_batch(self, hits, misses, sums, can_crit, rules: PullRules) -> tuple:
+        """Grade a batch of pulls into (failure, partial, full, crit) masks"""
+        if rules.sums:
+            failure = sums < rules.sum_partial
+            crit = ~failure & can_crit & (sums >= rules.sum_ceil)
+            full = ~failure & ~crit & (sums >= rules.sum_full)
+        else:
+            failure = (misses >= rules.miss_ceil) | (hits < rules.hit_partial)
+            crit = ~failure & can_crit & (hits >= rules.hit_ceil)
+            full = ~failure & ~crit & (hits >= rules.hit_full)
+        return (failure, ~failure & ~crit & ~full, full, crit)
+
+    def pull_one(
+        self, rank: int, type: PullType, rules: PullRules | None = None
+    ) -> list:
+        """Evaluate a pull from the bag(s)
+
+        rules defaults to the current pull configuration, which Resistance
+        and Befell pulls override with their own draws and ceilings.
+        """
+        _pull_one_logger.debug("%s", vars(self))
+        if rules is None:
+            rules = self.pull_rules()
         if type != PullType.Action:
-            self.max_draws = 3
-            self.miss_ceil = 30
-            self.hit_ceil = 30
-            self.ignores_ends_draws = True
-            self.sums = False
-        if type == PullType.Resistance:
-            do_resistance = True
+            rules = rules._replace(**_RESISTANCE_RULES)
 
+        # Get the replayable pull list.
+        # This handles "Return to Bag" abilities
+        the_pull = self._replayable_pull(rules=rules)
         pulls = []
         if type != PullType.Action:
-            rs = self._pull(rank, self._replayable_pull(), do_resistance)
+            do_resistance = type == PullType.Resistance
+            rs = self._pull(rank, the_pull, do_resistance, orders=True, rules=rules)
             if type == PullType.Resistance:
                 # Resistance, only counts Costs
-                del rs["hits"]
-                del rs["misses"]
-                del rs["fortune-hits"]
-                del rs["fortune-misses"]
-                del rs["sum"]
-                del rs["fortune-sum"]
-                del rs["can-crit"]
-                del rs["crit"]
-                del rs["full"]
-                del rs["partial"]
-                del rs["failure"]
-                del rs["fortune-crit"]
-                del rs["fortune-full"]
-                del rs["fortune-partial"]
-                del rs["fortune-failure"]
-                del rs["fortune-pull-order"]
+                pulls.append(rs.to_dict(_RESISTANCE_KEYS))
             else:
                 # Befell, only counts Hits
-                del rs["sum"]
-                del rs["misses"]
-                del rs["can-crit"]
-                del rs["crit"]
-                del rs["full"]
-                del rs["partial"]
-                del rs["failure"]
-                del rs["fortune-sum"]
-                del rs["fortune-misses"]
-                del rs["fortune-hits"]
-                del rs["fortune-crit"]
-                del rs["fortune-full"]
-                del rs["fortune-partial"]
-                del rs["fortune-failure"]
-                del rs["fortune-pull-order"]
-                del rs['costs']
-            pulls.append(rs)
+                pulls.append(rs.to_dict(_BEFELL_KEYS))
         else:
-            replayable_pull = self._replayable_pull()
             # Action, need to be able to stop at any point
-            for i in range(1, self.max_draws + 1):
-                rs = self._pull(
-                    rank,
-                    copy.deepcopy(replayable_pull)[0:i],
-                    False)
+            for rs in self._pull_draws(
+                rank, the_pull, False, self._draw_cap(rules), rules, orders=True
+            ):
                 # Action, Uses Hits/Misses, the results, and
                 # their Fortune variants currently
-                del rs["sum"]
-                del rs["fortune-sum"]
-                del rs['costs']
-                pulls.append(rs)
-
-        # Restore the base config
-        self.max_draws = copy.deepcopy(max_draws)
-        self.miss_ceil = copy.deepcopy(miss_ceil)
-        self.hit_ceil = copy.deepcopy(hit_ceil)
-        self.ignores_ends_draws = copy.deepcopy(ignores_end)
-        self.sums = copy.deepcopy(sums)
+                pulls.append(rs.to_dict(_ACTION_KEYS))
 
         return pulls
 
-    def resistance_pull(self) -> list:
-        """Evaluate a resistance pull from the bag(s)"""
-        # Get the replayable pull list.
-        # This handles "Return to Bag" abilities
-        the_pull = self._replayable_pull()
-
-        # Save our normal config and reset for resistance pulls
-        miss_ceil = self.miss_ceil
-        hit_ceil = self.hit_ceil
-        ignores_end = self.ignores_ends_draws
-        max_draws = self.max_draws
-        sums = self.sums
-        self.max_draws = 3
-        self.miss_ceil = 30
-        self.hit_ceil = 30
-        self.ignores_ends_draws = True
-        self.sums = False
+    def pull_many(
+        self,
+        rank: int,
+        type: PullType,
+        n: int,
+        orders: bool = False,
+        rules: PullRules | None = None,
+    ) -> dict:
+        """Evaluate n pulls like pull_one, returning the results as columns
+
+        Each of PULL_COLUMNS holds an array of the n results for every draw
+        cap, as columns[name][draw cap - 1][pull]. Action pulls have a result
+        for every draw cap, while Resistance and Befell pulls only have the
+        one for all their draws. With orders the pull orders are added as
+        lists of token names in the same layout.
+        """
+        if rules is None:
+            rules = self.pull_rules()
+        if type != PullType.Action:
+            rules = rules._replace(**_RESISTANCE_RULES)
+        resistance = type == PullType.Resistance
+        draws = self._draw_cap(rules)
+        # The draw caps to record the results at
+        caps = list(range(draws)) if type == PullType.Action else [draws - 1]
 
-        pulls = []
-        for draw_halt in range(1, self.max_draws + 1):
-            ranks = {"draws": draw_halt, "ranks": []}
+        results = {
+            "rank": rank,
+            "type": type.name,
+            "pulls": n,
+            "draws": [cap + 1 for cap in caps],
+        }
+        columns = {name: [array("i") for _ in caps] for name in PULL_COLUMNS}
+        if orders:
+            columns["pull-order"] = [[] for _ in caps]
+            columns["fortune-pull-order"] = [[] for _ in caps]
+        results.update(columns)
+
+        stats = self.stats
+        for _ in range(n):
+            the_pull = self._replayable_pull(rules=rules)
+            if stats is not None:
+                started = time.perf_counter()
+            state = self._pull_state(rank, resistance, rules, orders)
+            column = 0
+            for draw in range(draws):
+                if state["draw_again"] and draw < len(the_pull):
+                    self._pull_token(state, the_pull[draw])
+                if draw != caps[column]:
+                    continue
+                rs = self._pull_results(state)
+                for name, value in (
+                    ("hits", rs.hits),
+                    ("misses", rs.misses),
+                    ("sum", rs.sum),
+                    ("fortune-hits", rs.fortune_hits),
+                    ("fortune-misses", rs.fortune_misses),
+                    ("fortune-sum", rs.fortune_sum),
+                    ("can-crit", rs.can_crit),
+                    ("outcome", rs.outcome),
+                    ("fortune-outcome", rs.fortune_outcome),
+                    ("lost", rs.lost),
+                    ("taken", rs.taken),
+                    ("mitigated", rs.mitigated),
+                ):
+                    columns[name][column].append(value)
+                if orders:
+                    columns["pull-order"][column].append(list(rs.pull_order))
+                    columns["fortune-pull-order"][column].append(
+                        list(rs.fortune_pull_order)
+                    )
+                column += 1
+            if stats is not None:
+                stats.evaluations += 1
+                stats.evaluation_seconds += time.perf_counter() - started
 
-            for rank in range(self.max_rank + 1):
-                rs = self._pull(rank, copy.deepcopy(the_pull)[0:draw_halt], True)
-
-                del rs["hits"]
-                del rs["misses"]
-                del rs["fortune-hits"]
-                del rs["fortune-misses"]
-                del rs["sum"]
-                del rs["fortune-sum"]
-                del rs["can-crit"]
-                del rs["crit"]
-                del rs["full"]
-                del rs["partial"]
-                del rs["failure"]
-                del rs["fortune-crit"]
-                del rs["fortune-full"]
-                del rs["fortune-partial"]
-                del rs["fortune-failure"]
-                del rs["fortune-pull-order"]
-
-                ranks["ranks"].append(copy.deepcopy(rs))
-            pulls.append(copy.deepcopy(ranks))
-
-        # Restore the base config
-        self.max_draws = max_draws
-        self.miss_ceil = miss_ceil
-        self.hit_ceil = hit_ceil
-        self.ignores_ends_draws = ignores_end
-        self.sums = sums
+        return results
+
+    def resistance_pull(self, rules: PullRules | None = None) -> list:
+        """Evaluate a resistance pull from the bag(s)
+
+        rules defaults to the current pull configuration, which is overridden
+        with the draws and ceilings of Resistance pulls.
+        """
+        if rules is None:
+            rules = self.pull_rules()
+        rules = rules._replace(**_RESISTANCE_RULES)
+        # Get the replayable pull list.
+        # This handles "Return to Bag" abilities
+        the_pull = self._replayable_pull(rules=rules)
+
+        pulls = [
+            {"draws": draw_halt, "ranks": []}
+            for draw_halt in range(1, rules.max_draws + 1)
+        ]
+        for rank in range(rules.max_rank + 1):
+            results = self._pull_draws(
+                rank, the_pull, True, rules.max_draws, orders=True, rules=rules
+            )
+            for ranks, rs in zip(pulls, results, strict=True):
+                ranks["ranks"].append(rs.to_dict(_RESISTANCE_KEYS))
 
         return pulls
 
@@ -921,190 +2529,255 @@ class TokenBag:
 
         return (bool(test == actual), actual)
 
-    def _test_pull(self, pull: list, test: str) -> dict:
-        """Evaluates a single rank test pull"""
+    def _test_pull(
+        self,
+        pull: list,
+        test: "str | TestSpec",
+        rules: PullRules,
+        memo: dict | None = None,
+    ) -> dict:
+        """Evaluates a single rank test pull
+
+        test is a Tests DSL string or its compiled TestSpec. memo holds the
+        results of pulls already evaluated, to reuse across tests.
+        """
+        if memo is None:
+            memo = {}
+        if isinstance(test, str):
+            test = _parse_test(test)
         logger = logging.getLogger("tokenbag._test_pull")
-        test = test.replace(" ", "")
         results = {
-            "Pull": copy.deepcopy(pull),
-            "Test Request": test,
+            "Pull": list(pull),
+            "Test Request": test.text,
             "Tests": 0,
             "Valid": 0,
             "Failed": [],
         }
-
-        rank = int(test[0:1])
-        pSum = test.find("=")
-        pHit = test.find("&")
-        tSum = ""
-        tHit = ""
-
-        part = test.partition("=")
-        if pSum > 0:
-            # Sum is present
-            if pHit > 0 and pSum > pHit:
-                # Hit is present 1st, Sum is 2nd
-                tSum = part[2]
-                tHit = part[0].partition("&")[2]
-            elif pHit > pSum:
-                # Hit is present 2nd, Sum is 1st
-                part2 = part[2].partition("&")
-                tSum = part2[0]
-                tHit = part2[2]
-            else:
-                # Hit is not present, only Sum
-                tSum = part[2]
-        elif pHit > 0:
-            # Hit is present, Sum is not
-            part = test.partition("&")
-            tHit = part[2]
-
-        if not tHit and not tSum:
+        if test.error:
             results["Tests"] = 1
-            results["Failed"].append(test)
+            results["Failed"].append(test.text)
+            results["Error"] = f"{test.error} at position {test.position}"
             return results
 
-        try:
-            # evaluate sum test if present
-            if tSum:
-                self.sums = True
-                rs = self._pull(rank, copy.deepcopy(pull), False)
-                tr = tSum.split("$")
-                if tr[0]:
-                    # Base side, if given
-                    results["Tests"] += 1
-                    val = int(tr[0][:-1])
-                    res = tr[0][-1]
-                    (match, pull_actual) = self._test_result(
-                        fail=rs["failure"],
-                        partial=rs["partial"],
-                        full=rs["full"],
-                        crit=rs["crit"],
-                        test=res,
-                    )
-                    if val == rs["sum"] and match:
-                        results["Valid"] += 1
-                    else:
-                        logger.debug(rs)
-                        results["Failed"].append(
-                            f"{rank}={tr[0]}$;{rs['sum']}{pull_actual}$"
-                        )
-                        logger.debug(results["Failed"][-1])
-                if len(tr) > 1 and tr[1]:
-                    # Fortune side, if given
-                    results["Tests"] += 1
-                    val = int(tr[1][:-1])
-                    res = tr[1][-1]
-                    (match, pull_actual) = self._test_result(
-                        fail=rs["fortune-failure"],
-                        partial=rs["fortune-partial"],
-                        full=rs["fortune-full"],
-                        crit=rs["fortune-crit"],
-                        test=res,
-                    )
-                    if val == rs["fortune-sum"] and match:
-                        results["Valid"] += 1
-                    else:
-                        logger.debug(rs)
-                        results["Failed"].append(
-                            f"{rank}=${tr[1]};${rs['fortune-sum']}{pull_actual}"
-                        )
-                        logger.debug(results["Failed"][-1])
-
-            # Evaluate hit/miss test if present
-            if tHit:
-                self.sums = False
-                rs = self._pull(rank, copy.deepcopy(pull), False)
-                tr = tHit.split("$")
-                if tr[0]:
-                    # Base side, if given
-                    results["Tests"] += 1
-                    (hit, miss) = tr[0][:-1].split("/")
-                    hit = int(hit)
-                    miss = int(miss)
-                    res = tr[0][-1]
-                    (match, pull_actual) = self._test_result(
-                        fail=rs["failure"],
-                        partial=rs["partial"],
-                        full=rs["full"],
-                        crit=rs["crit"],
-                        test=res,
-                    )
-                    if hit == rs["hits"] and miss == rs["misses"] and match:
-                        results["Valid"] += 1
-                    else:
-                        logger.debug(rs)
-                        results["Failed"].append(
-                            f"{rank}&{tr[0]}$;"
-                            f"{rs['hits']}/{rs['misses']}{pull_actual}$"
-                        )
-                        logger.debug(results["Failed"][-1])
-                if len(tr) > 1 and tr[1]:
-                    # Fortune side, if given
-                    results["Tests"] += 1
-                    (hit, miss) = tr[1][:-1].split("/")
-                    hit = int(hit)
-                    miss = int(miss)
-                    res = tr[1][-1]
-                    (match, pull_actual) = self._test_result(
-                        fail=rs["fortune-failure"],
-                        partial=rs["fortune-partial"],
-                        full=rs["fortune-full"],
-                        crit=rs["fortune-crit"],
-                        test=res,
-                    )
-                    if (
-                        hit == rs["fortune-hits"]
-                        and miss == rs["fortune-misses"]
-                        and match
-                    ):
-                        results["Valid"] += 1
-                    else:
-                        logger.debug(rs)
-                        results["Failed"].append(
-                            f"{rank}&${tr[1]};"
-                            f"${rs['fortune-hits']}/{rs['fortune-misses']}{pull_actual}"
-                        )
-                        logger.debug(results["Failed"][-1])
-        except ValueError:
+        the_pull = tuple(self.pool["token_ids"][p] for p in pull)
+        rank = test.rank
+        for expected in test.expectations:
             results["Tests"] += 1
-            results["Failed"].append(test)
+            rs = self._test_pull_results(
+                rank, the_pull, memo, rules._replace(sums=expected.sums)
+            )
+            prefix = "fortune-" if expected.fortune else ""
+            (match, pull_actual) = self._test_result(
+                fail=rs[f"{prefix}failure"],
+                partial=rs[f"{prefix}partial"],
+                full=rs[f"{prefix}full"],
+                crit=rs[f"{prefix}crit"],
+                test=expected.result,
+            )
+            if expected.sums:
+                actual = f"{rs[f'{prefix}sum']}"
+                valid = expected.value == rs[f"{prefix}sum"]
+            else:
+                actual = f"{rs[f'{prefix}hits']}/{rs[f'{prefix}misses']}"
+                valid = (
+                    expected.value == rs[f"{prefix}hits"]
+                    and expected.misses == rs[f"{prefix}misses"]
+                )
 
-        return results
+            if valid and match:
+                results["Valid"] += 1
+                continue
+            logger.debug(rs)
+            kind = "=" if expected.sums else "&"
+            if expected.fortune:
+                results["Failed"].append(
+                    f"{rank}{kind}${expected.text};${actual}{pull_actual}"
+                )
+            else:
+                results["Failed"].append(
+                    f"{rank}{kind}{expected.text}$;{actual}{pull_actual}$"
+                )
+            logger.debug(results["Failed"][-1])
 
-    def verify_tests(self) -> tuple[bool, list]:
-        """Evaluate the Test Pulls and report results"""
+        return results
 
-        base_config = {
-            "max_draws": self.max_draws,
-            "sums": self.sums,
-            "hit_ceil_only_on_crit": self.hit_ceil_only_on_crit,
-            "hit_ceil": self.hit_ceil,
-            "hit_full": self.hit_full,
-            "hit_partial": self.hit_partial,
-            "miss_ceil": self.miss_ceil,
-            "sum_ceil": self.sum_ceil,
-            "sum_full": self.sum_full,
-            "sum_partial": self.sum_partial,
-            "sum_floor": self.sum_floor,
-            "bag_draws": copy.deepcopy(self.bag_draws),
-            "max_rank": self.max_rank,
-        }
+    def _test_pull_results(
+        self, rank: int, the_pull: tuple, memo: dict, rules: PullRules
+    ) -> dict:
+        """Return the results of a test pull, evaluating it only once"""
+        key = (rules, the_pull, rank)
+        if key not in memo:
+            memo[key] = self._pull(
+                rank, the_pull, False, rules=rules, counted=False
+            ).to_dict()
+        return memo[key]
+
+    def verify_tests(self, jobs: int = 1) -> tuple[bool, list]:
+        """Evaluate the Test Pulls and report results
+
+        Pulls are only evaluated once for each rank and pull configuration.
+        With jobs other than 1 the Test Pulls are split across that many
+        worker processes, 0 being one per CPU.
+        """
 
         test_results = []
-        passed_all = True
+        if jobs <= 0:
+            jobs = os.cpu_count() or 1
+        jobs = min(jobs, len(self.test_pulls))
+
+        if jobs > 1:
+            # Split the Test Pulls into a run of them per worker, in order
+            size = -(-len(self.test_pulls) // jobs)
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                futures = [
+                    executor.submit(
+                        _verify_tests, self, self.test_pulls[start : start + size]
+                    )
+                    for start in range(0, len(self.test_pulls), size)
+                ]
+                for future in futures:
+                    test_results.extend(future.result())
+        else:
+            memo = {}
+            for test in self.test_pulls:
+                # Apply any test specific configuration over the base one
+                rules = self.pull_rules(**test.get("Config", {}))
+                specs = test.get("Compiled Tests") or test["Tests"]
+                for spec in specs:
+                    test_results.append(
+                        self._test_pull(test["Pull"], spec, rules, memo)
+                    )
 
-        for test in self.test_pulls:
-            # Reset config to the base configuration
-            self.configure_pull(**base_config)
-            if "Config" in test:
-                # Load in any test specific configuration
-                self.configure_pull(**(test["Config"]))
+        passed_all = all(len(rs["Failed"]) == 0 for rs in test_results)
+        return (passed_all, test_results)
 
-            for test_pull in test["Tests"]:
-                rs = self._test_pull(copy.deepcopy(test["Pull"]), test_pull)
-                if len(rs["Failed"]) > 0:
-                    passed_all = False
-                test_results.append(rs)
 
-        return (passed_all, test_results)
+class _TestParser:
+    """Recursive descent parser for a rank test of the Tests DSL
+
+    rank (`=` sums | `&` hits) in either order, where each side is
+    base `$` fortune, either of which can be left out. A sum side is a
+    signed sum and a result, such as `-2.`, and a hit/miss side is hits `/`
+    misses and a result, such as `3/1+`. Spaces are ignored.
+    """
+
+    def __init__(self, test: str) -> None:
+        # Keep the position of each character in the original text
+        self.chars = [(i, c) for i, c in enumerate(test) if c != " "]
+        self.text = "".join(c for _, c in self.chars)
+        self.end = len(test)
+        self.at = 0
+
+    def position(self) -> int:
+        if self.at < len(self.chars):
+            return self.chars[self.at][0]
+        return self.end
+
+    def peek(self) -> str:
+        return self.text[self.at : self.at + 1]
+
+    def digit(self) -> bool:
+        # Only ASCII digits, as int() also takes digits such as `٣`
+        return self.peek().isascii() and self.peek().isdigit()
+
+    def error(self, message: str) -> ValueError:
+        found = f"`{self.peek()}`" if self.peek() else "the end"
+        return ValueError(f"{message}, found {found}", self.position())
+
+    def number(self, signed: bool) -> int:
+        start = self.at
+        if signed and self.peek() in ("-", "+"):
+            self.at += 1
+        while self.digit():
+            self.at += 1
+        if not self.text[start : self.at].lstrip("-+"):
+            raise self.error("Expected a number")
+        return int(self.text[start : self.at])
+
+    def side(self, sums: bool, fortune: bool) -> Expectation | None:
+        start = self.at
+        if self.peek() in ("", "$", "=", "&"):
+            return None
+        value = self.number(signed=True)
+        misses = 0
+        if not sums:
+            if self.peek() != "/":
+                raise self.error("Expected `/` between hits and misses")
+            self.at += 1
+            misses = self.number(signed=True)
+        result = self.peek()
+        if result not in (".", "-", "+", "^"):
+            raise self.error("Expected a result of `.`, `-`, `+` or `^`")
+        self.at += 1
+        text = self.text[start : self.at]
+        return Expectation(sums, fortune, value, misses, result, text)
+
+    def parse(self) -> TestSpec:
+        if not self.digit():
+            raise self.error("Expected a rank")
+        rank = int(self.peek())
+        self.at += 1
+
+        sections = {}
+        while self.peek():
+            kind = self.peek()
+            if kind not in ("=", "&") or kind in sections:
+                raise self.error(
+                    "Expected `=` or `&`" if not sections else "Expected the end"
+                )
+            self.at += 1
+            sums = kind == "="
+            expected = [self.side(sums, False)]
+            if self.peek() == "$":
+                self.at += 1
+                expected.append(self.side(sums, True))
+            sections[kind] = [e for e in expected if e is not None]
+            if not sections[kind]:
+                raise self.error("Expected a result to test")
+        if not sections:
+            raise self.error("Expected `=` or `&`")
+
+        # Sum tests are evaluated before hit/miss tests
+        expectations = tuple(sections.get("=", []) + sections.get("&", []))
+        return TestSpec(self.text, rank, expectations)
+
+
+@functools.lru_cache(maxsize=None)
+def _parse_test(test: str) -> TestSpec:
+    """Compile a rank test of the Tests DSL, see _TestParser"""
+    parser = _TestParser(test)
+    try:
+        return parser.parse()
+    except ValueError as e:
+        (message, position) = e.args
+        return TestSpec(parser.text, -1, (), message, position)
+
+
+def _stopping_rules(rules: PullRules) -> PullRules:
+    """Return rules with only the settings that change when a pull stops
+
+    Pulls evaluated by rules with the same stopping rules only differ in
+    their grading, by hit_full, hit_partial, sum_full and sum_partial. The
+    sum ceiling and floor only stop pulls that are graded by their sum.
+    """
+    stopping = rules._replace(hit_full=0, hit_partial=0, sum_full=0, sum_partial=0)
+    if not rules.sums:
+        stopping = stopping._replace(sum_ceil=0, sum_floor=0)
+    return stopping
+
+
+def _verify_tests(bag: TokenBag, test_pulls: list) -> list:
+    """Worker process entry point for TokenBag.verify_tests"""
+    bag.test_pulls = test_pulls
+    return bag.verify_tests()[1]
+
+
+def _simulate(bag: TokenBag, n: int, ranks: list, seed: int) -> tuple:
+    """Worker process entry point for TokenBag.simulate_parallel
+
+    Returns the outcome counts, and the stats of only this worker's pulls
+    when stats are enabled.
+    """
+    if bag.stats is not None:
+        bag.stats = PullStats()
+    return (bag.simulate(n, ranks, seed)["counts"], bag.stats)